@@ -0,0 +1,978 @@
+# Shared Data Hub GraphQL client.  Keeps one pooled, keep-alive requests.Session per tier so that
+# scripts issuing thousands of small queries reuse connections instead of paying a fresh TCP+TLS
+# handshake on every call.
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+TIERS = {
+    'DEV2': {'url': 'https://hub-dev2.datacommons.cancer.gov/api/graphql', 'token': 'DEV2API'},
+    #Note that use of Stage is for example purposes only, actual submissions should use the production URL.  If you wish to run tests on Stage, please contact the helpdesk.
+    'STAGE': {'url': 'https://hub-stage.datacommons.cancer.gov/api/graphql', 'token': 'STAGEAPI'},
+    'PROD': {'url': 'https://hub.datacommons.cancer.gov/api/graphql', 'token': 'PRODAPI'},
+}
+
+# Defaults used when a tier client is first created.  Change with configure() before the first query.
+POOL_SIZE = 10
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 300
+# Upper limit on requests in flight to one tier at the same time, no matter how many threads are querying
+MAX_IN_FLIGHT = POOL_SIZE
+# Token bucket limit in requests per second for each tier (0 means no limit) and how many requests can burst through at once
+RATE_LIMIT = 0
+BURST = 1
+# Retry policy for transient failures.  Waits grow as BACKOFF * 2^attempt (capped at MAX_BACKOFF) with full
+# jitter, unless the server sends a Retry-After header.
+MAX_ATTEMPTS = 5
+BACKOFF = 0.5
+MAX_BACKOFF = 30
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Paged query fields and the list each page holds, for paginate()
+PAGE_FIELDS = {
+    'submissionQCResults': 'results',
+    'aggregatedSubmissionQCResults': 'results',
+    'getSubmissionNodes': 'nodes',
+    'listSubmissions': 'submissions',
+}
+# Fields that identify a record in each paged list.  Offset windows over a sort key with ties can hand back
+# the same record twice, these are used to drop the repeats before the records are counted against total.
+PAGE_KEYS = {
+    'submissionQCResults': ('type', 'submittedID', 'validationType'),
+    'getSubmissionNodes': ('nodeType', 'nodeID'),
+    'listSubmissions': ('_id',),
+}
+PAGE_SIZE = 1000
+PAGE_WORKERS = 4
+# Response cache, off until enableCache() is called.  TTLs are in seconds and looked up by GraphQL operation name.
+CACHE_BYTES = 256 * 1024 * 1024
+CACHE_TTL = 60
+CACHE_TTLS = {
+    'GetMyUser': 600,
+    'ListSubmissions': 60,
+    'SubmissionStats': 30,
+    'ListBatches': 30,
+    'SummaryQueryQCResults': 120,
+    'DetailedQueryQCResults': 120,
+    'GetQCResults': 120,
+    'getSubmissionNodes': 120,
+}
+# Optional on-disk second level for the response cache, see enableCache(diskfile=...)
+DISK_CACHE_FILE = 'dh_query_cache.sqlite'
+DISK_CACHE_BYTES = 1024 * 1024 * 1024
+# Longest (seconds) past its expiry that a stored response is handed back when a query fails
+MAX_STALE = 24 * 3600
+
+_clients = {}
+_clients_lock = threading.Lock()
+_settings = {'pool_size': POOL_SIZE, 'connect_timeout': CONNECT_TIMEOUT, 'read_timeout': READ_TIMEOUT, 'max_in_flight': MAX_IN_FLIGHT,
+             'rate_limit': RATE_LIMIT, 'burst': BURST, 'max_attempts': MAX_ATTEMPTS, 'backoff': BACKOFF, 'max_backoff': MAX_BACKOFF}
+# Per tier overrides of _settings, set with configure(tier=...)
+_tier_settings = {}
+_async_clients = {}
+_cache = None
+# Requests currently on the wire, used to coalesce identical concurrent queries
+_inflight = {}
+_inflight_lock = threading.Lock()
+_async_inflight = {}
+
+
+class PageError(Exception):
+    pass
+
+
+class BatchError:
+    # Stands in for a batchQuery result when the API answered but reported errors for that entry.  Unlike
+    # None, which means the request itself failed, sending the same lookup again won't help.
+    def __init__(self, messages):
+        self.messages = messages
+
+    def __repr__(self):
+        return f"BatchError({self.messages})"
+
+
+class RateLimiter:
+    # Token bucket plus in-flight cap for one tier, shared by every thread and asyncio task using that tier.
+    # Use "with limiter:" from threads or "await limiter.acquireAsync()" / "limiter.release()" from coroutines.
+    def __init__(self, rate=RATE_LIMIT, burst=BURST, max_concurrent=MAX_IN_FLIGHT):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_concurrent = max_concurrent
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        self.requests = 0
+        self.waits = 0
+        self.total_wait = 0.0
+        self.last_wait = 0.0
+
+    def _reserve(self):
+        # Called with cond held.  Takes a slot and a token and returns 0, or returns how long to wait
+        # before trying again (None when waiting on a free in-flight slot rather than a token).
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.in_flight >= self.max_concurrent:
+            return None
+        if self.rate > 0:
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens = self.tokens - 1
+        self.in_flight = self.in_flight + 1
+        self.requests = self.requests + 1
+        return 0
+
+    def _recordWait(self, waited):
+        with self.cond:
+            self.last_wait = waited
+            if waited > 0.001:
+                self.waits = self.waits + 1
+                self.total_wait = self.total_wait + waited
+
+    def acquire(self):
+        start = time.monotonic()
+        with self.cond:
+            wait = self._reserve()
+            while wait != 0:
+                # release() wakes us early when an in-flight slot frees up
+                self.cond.wait(wait)
+                wait = self._reserve()
+        self._recordWait(time.monotonic() - start)
+
+    async def acquireAsync(self):
+        start = time.monotonic()
+        while True:
+            with self.cond:
+                wait = self._reserve()
+            if wait == 0:
+                break
+            await asyncio.sleep(0.01 if wait is None else wait)
+        self._recordWait(time.monotonic() - start)
+
+    def release(self):
+        with self.cond:
+            self.in_flight = self.in_flight - 1
+            self.cond.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def metrics(self):
+        with self.cond:
+            if self.rate > 0 and self.tokens < 1:
+                current_wait = (1 - self.tokens) / self.rate
+            else:
+                current_wait = 0.0
+            return {'requests': self.requests,
+                    'in_flight': self.in_flight,
+                    'waits': self.waits,
+                    'total_wait': self.total_wait,
+                    'average_wait': self.total_wait / self.waits if self.waits > 0 else 0.0,
+                    'last_wait': self.last_wait,
+                    'current_wait': current_wait}
+
+
+class DHClient:
+    def __init__(self, tier, pool_size=POOL_SIZE, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, max_in_flight=MAX_IN_FLIGHT,
+                 rate_limit=RATE_LIMIT, burst=BURST, max_attempts=MAX_ATTEMPTS, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+        self.tier = tier
+        self.url = TIERS[tier]['url']
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiter = RateLimiter(rate_limit, burst, max_in_flight)
+        self.session = requests.Session()
+        # pool_block keeps the number of open connections at pool_size even when more threads are querying
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({"Authorization": f"Bearer {os.environ[TIERS[tier]['token']]}",
+                                     "Connection": "keep-alive"})
+
+    def retryWait(self, attempt, result=None):
+        if result is not None and result.headers.get('Retry-After') is not None:
+            retryafter = result.headers['Retry-After']
+            try:
+                return max(0, float(retryafter))
+            except ValueError:
+                try:
+                    return max(0, parsedate_to_datetime(retryafter).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    def query(self, query, variables=None, queryprint=False, idempotent=None):
+        payload = buildPayload(query, variables, queryprint)
+        # A mutation may already have been applied when a response is lost, so by default it is only
+        # retried when the server definitely did not act on it (connect failures and 429s)
+        if idempotent is None:
+            idempotent = not isMutation(query)
+        attempt = 0
+        while True:
+            attempt = attempt + 1
+            result = None
+            try:
+                with self.limiter:
+                    result = self.session.post(url=self.url, json=payload, timeout=self.timeout)
+                if result.status_code == 200:
+                    return result.json()
+                retry = result.status_code == 429 or (idempotent and result.status_code in RETRY_STATUSES)
+                error = f"Error: {result.status_code}"
+            except requests.exceptions.ConnectTimeout as e:
+                retry = True
+                error = f"HTTP Error: {e}"
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                retry = idempotent
+                error = f"HTTP Error: {e}"
+            except requests.exceptions.RequestException as e:
+                return(f"HTTP Error: {e}")
+            if not retry or attempt >= self.max_attempts:
+                print(error)
+                if result is not None:
+                    return result.content
+                return error
+            time.sleep(self.retryWait(attempt, result))
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncDHClient:
+    # asyncio version of DHClient for one tier and event loop.  Uses an httpx.AsyncClient connection pool when
+    # httpx is installed, otherwise runs the pooled sync client in the loop's thread pool.  Retry policy and
+    # rate limiter are shared with the sync client for the same tier.
+    def __init__(self, tier):
+        self.sync = getClient(tier)
+        self.loop = asyncio.get_running_loop()
+        self.http = None
+        if httpx is not None:
+            self.http = httpx.AsyncClient(
+                headers=dict(self.sync.session.headers),
+                limits=httpx.Limits(max_connections=self.sync.pool_size, max_keepalive_connections=self.sync.pool_size),
+                timeout=httpx.Timeout(self.sync.timeout[1], connect=self.sync.timeout[0])
+            )
+
+    async def query(self, query, variables=None, queryprint=False, idempotent=None):
+        if self.http is None:
+            return await self.loop.run_in_executor(None, functools.partial(self.sync.query, query, variables, queryprint, idempotent))
+        payload = buildPayload(query, variables, queryprint)
+        if idempotent is None:
+            idempotent = not isMutation(query)
+        limiter = self.sync.limiter
+        attempt = 0
+        while True:
+            attempt = attempt + 1
+            result = None
+            try:
+                await limiter.acquireAsync()
+                try:
+                    result = await self.http.post(self.sync.url, json=payload)
+                finally:
+                    limiter.release()
+                if result.status_code == 200:
+                    return result.json()
+                retry = result.status_code == 429 or (idempotent and result.status_code in RETRY_STATUSES)
+                error = f"Error: {result.status_code}"
+            except httpx.ConnectTimeout as e:
+                retry = True
+                error = f"HTTP Error: {e}"
+            except (httpx.TimeoutException, httpx.NetworkError) as e:
+                retry = idempotent
+                error = f"HTTP Error: {e}"
+            except (httpx.HTTPError, ValueError) as e:
+                return(f"HTTP Error: {e}")
+            if not retry or attempt >= self.sync.max_attempts:
+                print(error)
+                if result is not None:
+                    return result.content
+                return error
+            await asyncio.sleep(self.sync.retryWait(attempt, result))
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.aclose()
+
+
+class DiskCache:
+    # SQLite store of query responses that survives restarts and can be shared by several processes.  Rows are
+    # namespaced by tier and token (see cacheNamespace), expire after their TTL, and the least recently used are deleted once the stored
+    # responses pass max_bytes.  Expired rows are kept until evicted so they can be handed back as the last
+    # known state when the API fails.
+    def __init__(self, filename=DISK_CACHE_FILE, max_bytes=DISK_CACHE_BYTES):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (tier TEXT, query TEXT, variables TEXT, expires REAL, used REAL, size INTEGER, response TEXT, PRIMARY KEY (tier, query, variables))")
+        self.conn.commit()
+
+    def get(self, key, stale=False):
+        # Returns (seconds left to live, response) or None.  With stale, expired rows are returned too.
+        with self.lock:
+            row = self.conn.execute("SELECT expires, response FROM responses WHERE tier = ? AND query = ? AND variables = ?", key).fetchone()
+            if row is None or (row[0] < time.time() and not stale):
+                return None
+            self.conn.execute("UPDATE responses SET used = ? WHERE tier = ? AND query = ? AND variables = ?", (time.time(),) + key)
+            self.conn.commit()
+        return row[0] - time.time(), json.loads(row[1])
+
+    def put(self, key, text, ttl):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)", key + (time.time() + ttl, time.time(), len(text), text))
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                # Walk from least recently used, deleting until back under the cap
+                excess = total - self.max_bytes
+                victims = []
+                for rowid, size in self.conn.execute("SELECT rowid, size FROM responses ORDER BY used"):
+                    if excess <= 0:
+                        break
+                    victims.append((rowid,))
+                    excess = excess - size
+                self.conn.executemany("DELETE FROM responses WHERE rowid = ?", victims)
+            self.conn.commit()
+
+    def reopen(self):
+        # SQLite connections can't be used across fork, a child process opens its own
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+
+    def invalidate(self, tier=None):
+        with self.lock:
+            if tier is None:
+                self.conn.execute("DELETE FROM responses")
+            else:
+                self.conn.execute("DELETE FROM responses WHERE tier = ? OR tier LIKE ?", (tier, tier + '#%'))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class ResponseCache:
+    # In-memory LRU cache of successful query responses keyed by (namespace, query with whitespace collapsed, variables).
+    # Entries expire after their operation's TTL and the least recently used ones are dropped once the cached
+    # responses add up to more than max_bytes.  Cached responses are shared between callers, so don't modify them.
+    # With a DiskCache as disk, responses are also written through to disk and memory misses are filled from it.
+    def __init__(self, max_bytes=CACHE_BYTES, ttl=CACHE_TTL, ttls=None, disk=None, max_stale=MAX_STALE):
+        self.disk = disk
+        self.max_stale = max_stale
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.ttls = dict(CACHE_TTLS)
+        if ttls is not None:
+            self.ttls.update(ttls)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def ttlFor(self, query):
+        match = re.match(r'\s*query\s+(\w+)', query)
+        if match is not None and match.group(1) in self.ttls:
+            return self.ttls[match.group(1)]
+        return self.ttl
+
+    def get(self, key, count=True):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] >= time.monotonic():
+                self.entries.move_to_end(key)
+                if count:
+                    self.hits = self.hits + 1
+                return entry[2]
+            if entry is not None:
+                self._drop(key)
+        stored = None
+        if self.disk is not None:
+            stored = self.disk.get(key)
+        with self.lock:
+            if stored is None:
+                if count:
+                    self.misses = self.misses + 1
+                return None
+            if count:
+                self.hits = self.hits + 1
+        self._remember(key, stored[1], stored[0], len(json.dumps(stored[1])))
+        return stored[1]
+
+    def put(self, key, query, response):
+        # Errors are never cached
+        if not isinstance(response, dict) or 'errors' in response:
+            return
+        ttl = self.ttlFor(query)
+        if ttl <= 0:
+            return
+        text = json.dumps(response)
+        self._remember(key, response, ttl, len(text))
+        if self.disk is not None:
+            self.disk.put(key, text, ttl)
+
+    def _remember(self, key, response, ttl, size):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (time.monotonic() + ttl, size, response)
+            self.size = self.size + size
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+
+    def resolve(self, key, query, response):
+        # Caches a fresh response.  If the request failed, hands back the last stored response for the key
+        # when the disk cache has one that expired no more than max_stale seconds ago, otherwise the failure.
+        if isinstance(response, dict) and 'errors' not in response:
+            self.put(key, query, response)
+            return response
+        if self.disk is not None:
+            stored = self.disk.get(key, stale=True)
+            if stored is not None and -stored[0] <= self.max_stale:
+                print(f"Query failed, using the response cached {max(0, -stored[0]):.0f} seconds past its expiry")
+                return stored[1]
+        return response
+
+    def _drop(self, key):
+        entry = self.entries.pop(key)
+        self.size = self.size - entry[1]
+
+    def invalidate(self, tier=None):
+        with self.lock:
+            for key in [key for key in self.entries if tier is None or key[0].split('#')[0] == tier]:
+                self._drop(key)
+        if self.disk is not None:
+            self.disk.invalidate(tier)
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
+
+    def reopen(self):
+        # The lock may have been held by another thread at fork time
+        self.lock = threading.Lock()
+        if self.disk is not None:
+            self.disk.reopen()
+
+
+def cacheNamespace(tier):
+    # Cached responses belong to the account that fetched them, so they are filed under the tier plus a hash
+    # of its token.  After the token changes the old account's responses are never handed back.
+    token = ''
+    if tier in TIERS:
+        token = os.environ.get(TIERS[tier]['token'], '')
+    return f"{tier}#{hashlib.sha256(token.encode()).hexdigest()[:16]}"
+
+
+def requestKey(tier, query, variables):
+    return (cacheNamespace(tier), ' '.join(query.split()), json.dumps(variables, sort_keys=True))
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def singleFlight(key, func):
+    # The first thread to ask for key runs func, any thread asking for the same key while that is running
+    # waits for it and gets the same result instead of sending its own request.
+    with _inflight_lock:
+        flight = _inflight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _Flight()
+            _inflight[key] = flight
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+    try:
+        flight.result = func()
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+        flight.done.set()
+    return flight.result
+
+
+async def singleFlightAsync(key, func):
+    # asyncio version of singleFlight.  func is a coroutine function run once as a shared task; the task is
+    # only cancelled when every caller waiting on it has been cancelled.
+    flightkey = (id(asyncio.get_running_loop()), key)
+    flight = _async_inflight.get(flightkey)
+    if flight is None:
+        flight = {'task': asyncio.ensure_future(func()), 'waiters': 0}
+        _async_inflight[flightkey] = flight
+        flight['task'].add_done_callback(lambda task: _async_inflight.pop(flightkey) if _async_inflight.get(flightkey) is flight else None)
+    flight['waiters'] = flight['waiters'] + 1
+    try:
+        return await asyncio.shield(flight['task'])
+    except asyncio.CancelledError:
+        if flight['waiters'] == 1:
+            flight['task'].cancel()
+        raise
+    finally:
+        flight['waiters'] = flight['waiters'] - 1
+
+
+def enableCache(max_bytes=CACHE_BYTES, ttl=CACHE_TTL, ttls=None, diskfile=None, disk_bytes=DISK_CACHE_BYTES, max_stale=MAX_STALE):
+    # Turns on response caching for apiQuery/apiQueryAsync.  ttls overrides CACHE_TTLS per operation name.
+    # diskfile adds a persistent SQLite cache behind the in-memory one so restarts start warm and failed
+    # queries fall back to the last known response, as long as it expired no more than max_stale seconds ago.
+    global _cache
+    disableCache()
+    disk = None
+    if diskfile is not None:
+        disk = DiskCache(diskfile, disk_bytes)
+    _cache = ResponseCache(max_bytes, ttl, ttls, disk, max_stale)
+    return _cache
+
+
+def disableCache():
+    global _cache
+    if _cache is not None and _cache.disk is not None:
+        _cache.disk.close()
+    _cache = None
+
+
+def invalidateCache(tier=None):
+    # Drops cached responses for one tier, or everything
+    if _cache is not None:
+        _cache.invalidate(normalizeTier(tier))
+
+
+def buildPayload(query, variables, queryprint=False):
+    if queryprint:
+        print(query)
+        if variables is not None:
+            print(variables)
+    if variables is None:
+        return {"query": query}
+    return {"query": query, "variables": variables}
+
+
+def isMutation(query):
+    return query.lstrip().startswith('mutation')
+
+
+def normalizeTier(tier):
+    # Shiny multi-selects hand back a tuple of selected values
+    if isinstance(tier, (list, tuple)):
+        tier = tier[0] if len(tier) > 0 else None
+    if tier is None:
+        return None
+    return tier.upper()
+
+
+def configure(tier=None, **settings):
+    # Changes the settings (any DHClient keyword argument) used for new tier clients and drops any
+    # existing ones so they are rebuilt.  Settings passed as None are left alone.  With tier the
+    # settings only apply to that tier, for example configure(tier='PROD', rate_limit=5).
+    if tier is None:
+        target = _settings
+    else:
+        target = _tier_settings.setdefault(normalizeTier(tier), {})
+    for key, value in settings.items():
+        if key not in _settings:
+            raise TypeError(f"Unknown client setting {key}")
+        if value is not None:
+            target[key] = value
+    closeClients()
+
+
+def getClient(tier):
+    tier = normalizeTier(tier)
+    with _clients_lock:
+        if tier not in _clients:
+            settings = dict(_settings)
+            settings.update(_tier_settings.get(tier, {}))
+            _clients[tier] = DHClient(tier, **settings)
+        return _clients[tier]
+
+
+def closeClients():
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+def _afterFork():
+    # A forked child (such as a Dash background callback) must not share the parent's sockets, SQLite
+    # connection or locks, so it starts with fresh ones and builds its own clients on first use.
+    global _clients_lock, _inflight_lock
+    _clients_lock = threading.Lock()
+    _clients.clear()
+    _async_clients.clear()
+    _inflight_lock = threading.Lock()
+    _inflight.clear()
+    _async_inflight.clear()
+    if _cache is not None:
+        _cache.reopen()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_afterFork)
+
+
+def getAsyncClient(tier):
+    # One async client per tier for the running event loop
+    tier = normalizeTier(tier)
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(tier)
+    if client is None or client.loop is not loop or client.sync is not getClient(tier):
+        client = AsyncDHClient(tier)
+        _async_clients[tier] = client
+    return client
+
+
+def tierError(tier):
+    if normalizeTier(tier) is None:
+        return("No tier specified")
+    if normalizeTier(tier) not in TIERS:
+        return(f"Please provide one of {', '.join(TIERS.keys())} as tier values")
+    return None
+
+
+async def apiQueryAsync(tier, query, variables, queryprint=False, idempotent=None, timeout=None, cache=True):
+    # Same as apiQuery but awaitable.  timeout (seconds) bounds the whole call including retries, and
+    # cancelling the awaiting task cancels the request.
+    if tierError(tier) is not None:
+        return tierError(tier)
+    tier = normalizeTier(tier)
+    if isMutation(query):
+        res = await _withTimeout(getAsyncClient(tier).query(query, variables, queryprint, idempotent), timeout)
+        if _cache is not None:
+            _cache.invalidate(tier)
+        return res
+    key = requestKey(tier, query, variables)
+    usecache = _cache is not None and cache
+    if usecache:
+        res = _cache.get(key)
+        if res is not None:
+            return res
+
+    async def fetch():
+        # Another request for this key may have filled the cache while we were waiting to go
+        if usecache:
+            res = _cache.get(key, count=False)
+            if res is not None:
+                return res
+        res = await getAsyncClient(tier).query(query, variables, queryprint, idempotent)
+        if usecache:
+            res = _cache.resolve(key, query, res)
+        return res
+    return await _withTimeout(singleFlightAsync(key, fetch), timeout)
+
+
+async def _withTimeout(call, timeout):
+    if timeout is None:
+        return await call
+    try:
+        return await asyncio.wait_for(call, timeout)
+    except asyncio.TimeoutError:
+        return(f"HTTP Error: no response after {timeout} seconds")
+
+
+async def gatherQueries(tier, querylist, timeout=None):
+    # Runs a list of (query, variables) pairs concurrently on the running event loop, results in list order
+    return await asyncio.gather(*[apiQueryAsync(tier, query, variables, timeout=timeout) for query, variables in querylist])
+
+
+def limiterMetrics(tier):
+    # Request count, in-flight count and rate limiter wait times for a tier
+    return getClient(tier).limiter.metrics()
+
+
+def apiQuery(tier, query, variables, queryprint=False, idempotent=None, cache=True):
+    # cache=False skips the response cache for this call.  Mutations always skip it and clear the tier's
+    # cached responses since they can change anything a query returns.  Queries are never sent twice at the same time.
+    if tierError(tier) is not None:
+        return tierError(tier)
+    tier = normalizeTier(tier)
+    if isMutation(query):
+        res = getClient(tier).query(query, variables, queryprint, idempotent)
+        if _cache is not None:
+            _cache.invalidate(tier)
+        return res
+    key = requestKey(tier, query, variables)
+    usecache = _cache is not None and cache
+    if usecache:
+        res = _cache.get(key)
+        if res is not None:
+            return res
+
+    def fetch():
+        # Another request for this key may have filled the cache while we were waiting to go
+        if usecache:
+            res = _cache.get(key, count=False)
+            if res is not None:
+                return res
+        res = getClient(tier).query(query, variables, queryprint, idempotent)
+        if usecache:
+            res = _cache.resolve(key, query, res)
+        return res
+    # Identical queries already on the wire share that request's response
+    return singleFlight(key, fetch)
+
+
+def fanOut(func, arglist, workers=1):
+    # Calls func(*args) for every entry in arglist using up to workers threads.  Results are yielded
+    # in the same order as arglist no matter which call finishes first, so output stays deterministic.
+    if workers <= 1:
+        for args in arglist:
+            yield func(*args)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for result in pool.map(lambda args: func(*args), arglist):
+                yield result
+
+
+def buildBatchQuery(batchspec, count):
+    # Packs count copies of one query field into a single GraphQL document.  Each copy gets the alias
+    # b0, b1, ... and its own set of variables named <argument>_<n> so results can be matched back up.
+    vardefs = []
+    fields = []
+    for i in range(count):
+        arguments = []
+        for arg, argtype in batchspec['args'].items():
+            vardefs.append(f"${arg}_{i}: {argtype}")
+            arguments.append(f"{arg}: ${arg}_{i}")
+        fields.append(f"b{i}: {batchspec['field']}({', '.join(arguments)}){batchspec['selection']}")
+    return f"query Batch_{batchspec['field']}({', '.join(vardefs)}){{\n" + "\n".join(fields) + "\n}"
+
+
+def _runBatch(tier, batchspec, varlist):
+    variables = {}
+    for i, entry in enumerate(varlist):
+        for arg in batchspec['args']:
+            variables[f"{arg}_{i}"] = entry[arg]
+    res = apiQuery(tier, buildBatchQuery(batchspec, len(varlist)), variables)
+    if not isinstance(res, dict):
+        # Transport failure, worth retrying
+        return [None] * len(varlist)
+    if res.get('data') is None:
+        if 'errors' not in res:
+            return [None] * len(varlist)
+        # The query was answered with errors and no data at all
+        messages = [error.get('message') for error in res['errors']]
+        return [BatchError(messages) for entry in varlist]
+    # Any alias that shows up in an error path gets its errors back, the rest of the batch is still good
+    failed = {}
+    for error in res.get('errors', []):
+        if error.get('path'):
+            failed.setdefault(error['path'][0], []).append(error.get('message'))
+    results = []
+    for i in range(len(varlist)):
+        if f"b{i}" in failed:
+            results.append(BatchError(failed[f"b{i}"]))
+        else:
+            results.append(res['data'].get(f"b{i}"))
+    return results
+
+
+def batchQuery(tier, batchspec, varlist, batchsize=100, workers=1):
+    # Runs one query per entry in varlist, batchsize entries per HTTP request.  Yields the result for
+    # each entry in varlist order, a BatchError if the API reported errors for that entry, or None if
+    # the request carrying it failed.
+    batches = []
+    for start in range(0, len(varlist), batchsize):
+        batches.append((tier, batchspec, varlist[start:start+batchsize]))
+    for results in fanOut(_runBatch, batches, workers):
+        for result in results:
+            yield result
+
+
+def fetchPage(tier, query, variables, field, offset, pagesize):
+    pagevars = dict(variables)
+    pagevars['first'] = pagesize
+    pagevars['offset'] = offset
+    res = apiQuery(tier, query, pagevars)
+    if not isinstance(res, dict) or res.get('data') is None or res['data'].get(field) is None:
+        raise PageError(f"{field} page at offset {offset} failed: {res}")
+    return res['data'][field]
+
+
+def _distinct(field, records, seen):
+    # records less any whose PAGE_KEYS fields are already in seen, which is updated with the ones kept
+    keys = PAGE_KEYS.get(field)
+    if keys is None:
+        return list(records)
+    kept = []
+    for record in records:
+        key = tuple(record.get(name) for name in keys)
+        if key not in seen:
+            seen.add(key)
+            kept.append(record)
+    return kept
+
+
+def paginate(tier, query, variables, field, pagesize=PAGE_SIZE, prefetch=False):
+    # Walks a paged query (any field in PAGE_FIELDS) pagesize records at a time instead of asking for
+    # everything with first: -1, yielding each page's field payload (total, the record list, and any
+    # other fields such as properties).  With prefetch the next page is requested while the caller
+    # works on the current one.  Records already yielded on an earlier page are left out.  Raises
+    # PageError if a page can't be fetched, or once the pages are done if they held fewer distinct
+    # records than total.
+    listkey = PAGE_FIELDS[field]
+    offset = 0
+    seen = set()
+    count = 0
+    total = None
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = None
+        while True:
+            if pending is not None:
+                page = pending.result()
+            else:
+                page = fetchPage(tier, query, variables, field, offset, pagesize)
+            pending = None
+            records = page.get(listkey) or []
+            offset = offset + len(records)
+            total = page.get('total')
+            # total is the authority when there is one, the server may send back fewer than pagesize records
+            if total is not None:
+                more = len(records) > 0 and offset < total
+            else:
+                more = len(records) == pagesize
+            if more and prefetch:
+                pending = pool.submit(fetchPage, tier, query, variables, field, offset, pagesize)
+            distinct = _distinct(field, records, seen)
+            count = count + len(distinct)
+            if len(distinct) < len(records):
+                # Pages can come from the response cache, so they are copied rather than changed
+                page = dict(page)
+                page[listkey] = distinct
+            yield page
+            if not more:
+                break
+    if total is not None and count != total:
+        raise PageError(f"{field} pages held {count} distinct records but the total is {total}")
+
+
+def _pageOffsets(first, field, pagesize):
+    # Offsets of the pages still needed after the first page, worked out from its total.  The windows step by
+    # the number of records the first page actually held, in case the server caps pages below pagesize.
+    total = first.get('total')
+    step = len(first.get(PAGE_FIELDS[field]) or [])
+    if total is None or step == 0:
+        return []
+    return list(range(step, total, step))
+
+
+def _assemble(first, field, pages):
+    # The first page's payload with the records of every page, repeats dropped
+    listkey = PAGE_FIELDS[field]
+    seen = set()
+    combined = dict(first)
+    combined[listkey] = _distinct(field, first.get(listkey) or [], seen)
+    for page in pages:
+        combined[listkey].extend(_distinct(field, page.get(listkey) or [], seen))
+    return combined
+
+
+def _incomplete(combined, field, pagesize):
+    # True if the assembled records don't add up to the total, or there is no total and the single page
+    # fetched was full so there may be more
+    records = combined.get(PAGE_FIELDS[field]) or []
+    if combined.get('total') is None:
+        return pagesize > 0 and len(records) >= pagesize
+    return len(records) != combined['total']
+
+
+def _checkWhole(whole, field):
+    # whole is a first: -1 payload, the fallback when the offset windows didn't add up
+    combined = _assemble(whole, field, [])
+    if _incomplete(combined, field, -1):
+        raise PageError(f"{field} returned {len(combined[PAGE_FIELDS[field]])} distinct records but the total is {combined['total']}")
+    return combined
+
+
+def _reporting(pages, progress, pagecount):
+    # Passes pages through, calling progress(pages done, total pages) as each one arrives
+    done = 1
+    for page in pages:
+        done = done + 1
+        progress(done, pagecount)
+        yield page
+
+
+def fetchAll(tier, query, variables, field, pagesize=PAGE_SIZE, workers=PAGE_WORKERS, progress=None):
+    # Bulk version of paginate: fetches the first page, uses its total to work out the remaining offset
+    # windows and fetches those in parallel, then returns the first page's payload with every record in order.
+    # progress, if given, is called as progress(pages done, total pages) while the pages come in.
+    # If the windows repeated or skipped records (their sort key has ties) the whole list is fetched in one
+    # first: -1 request instead, and PageError is raised if that doesn't match total either.
+    first = fetchPage(tier, query, variables, field, 0, pagesize)
+    arglist = [(tier, query, variables, field, offset, pagesize) for offset in _pageOffsets(first, field, pagesize)]
+    pages = fanOut(fetchPage, arglist, workers)
+    if progress is not None:
+        progress(1, len(arglist) + 1)
+        pages = _reporting(pages, progress, len(arglist) + 1)
+    combined = _assemble(first, field, pages)
+    if _incomplete(combined, field, pagesize):
+        combined = _checkWhole(fetchPage(tier, query, variables, field, 0, -1), field)
+    return combined
+
+
+async def fetchPageAsync(tier, query, variables, field, offset, pagesize):
+    pagevars = dict(variables)
+    pagevars['first'] = pagesize
+    pagevars['offset'] = offset
+    res = await apiQueryAsync(tier, query, pagevars)
+    if not isinstance(res, dict) or res.get('data') is None or res['data'].get(field) is None:
+        raise PageError(f"{field} page at offset {offset} failed: {res}")
+    return res['data'][field]
+
+
+async def fetchAllAsync(tier, query, variables, field, pagesize=PAGE_SIZE, workers=PAGE_WORKERS, progress=None):
+    # asyncio version of fetchAll, at most workers pages are requested at once
+    first = await fetchPageAsync(tier, query, variables, field, 0, pagesize)
+    limit = asyncio.Semaphore(workers)
+    offsets = _pageOffsets(first, field, pagesize)
+    done = [1]
+    if progress is not None:
+        progress(1, len(offsets) + 1)
+
+    async def limited(offset):
+        async with limit:
+            page = await fetchPageAsync(tier, query, variables, field, offset, pagesize)
+        if progress is not None:
+            done[0] = done[0] + 1
+            progress(done[0], len(offsets) + 1)
+        return page
+    pages = await asyncio.gather(*[limited(offset) for offset in offsets])
+    combined = _assemble(first, field, pages)
+    if _incomplete(combined, field, pagesize):
+        combined = _checkWhole(await fetchPageAsync(tier, query, variables, field, 0, -1), field)
+    return combined
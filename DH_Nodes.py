@@ -0,0 +1,27 @@
+# Turns getSubmissionNodes (and retrieveReleasedDataByID) payloads into DataFrames.  Every node's props
+# JSON string is decoded in one bulk parse and the table is built in one go instead of a row at a time.
+import json
+import pandas as pd
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def decodeProps(propslist):
+    # Decodes a list of props JSON strings.  They are joined into a single JSON array so the parser is
+    # called once instead of once per node, using orjson when it is installed.
+    text = '[' + ','.join(propslist) + ']'
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def nodeTable(payload):
+    # payload is a getSubmissionNodes result (properties plus a nodes list).  Columns are the query's
+    # properties list, in order, and dtypes are inferred per column from the decoded values.
+    records = decodeProps([node['props'] for node in payload['nodes']])
+    columns = payload.get('properties')
+    if not columns:
+        columns = None
+    return pd.DataFrame.from_records(records, columns=columns).infer_objects()
@@ -0,0 +1,121 @@
+# Flattens submissionQCResults payloads into one columnar table for the dashboards.  Each error and warning
+# message becomes a row, built in a single pass over the results instead of appending to a DataFrame.
+import re
+import sys
+import threading
+import numpy as np
+import pandas as pd
+
+# Columns QCIndex can look rows up by
+INDEX_COLUMNS = ['title', 'severity', 'node', 'batchID', 'kind']
+QC_COLUMNS = ['severity', 'node', 'validationType', 'displayID', 'batchID', 'submittedID', 'kind', 'title', 'description']
+# Columns with a handful of distinct values repeated across every message, stored dictionary encoded
+CATEGORY_COLUMNS = ['severity', 'node', 'validationType', 'batchID', 'kind', 'title']
+# description is made categorical too when it has at most this many distinct values per row, which is
+# the case for templated messages
+CATEGORY_RATIO = 0.5
+# Message lists in a QC result and the kind each one is labeled with
+KINDS = {'errors': 'Error', 'warnings': 'Warning'}
+# Descriptions look like "[node: id] message text [details]", the message is the text after the first ]
+# up to the next [ or ]
+MESSAGE_PATTERN = r'^[^\]]*\]([^\[\]]*)'
+# Normalized descriptions kept for reuse, cleared when it gets bigger than this
+NORMALIZED_MAX = 100000
+_normalized = {}
+_normalized_lock = threading.Lock()
+
+
+def intern(value):
+    # Repeated strings from the JSON payload become one shared object
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+def flattenQCResults(results, kinds=('errors', 'warnings')):
+    # results is the list from submissionQCResults.  kinds picks which message lists are flattened.
+    # severity and node are the QC result's severity and node type, kind is Error or Warning for the message.
+    # Strings are interned as they are collected and the repetitive columns come back as categoricals.
+    columns = dict((column, []) for column in QC_COLUMNS)
+    for result in results:
+        severity = intern(result['severity'])
+        node = intern(result['type'])
+        validationtype = intern(result.get('validationType'))
+        batchid = intern(result.get('batchID'))
+        submittedid = intern(result.get('submittedID'))
+        for kind in kinds:
+            for message in result.get(kind) or []:
+                columns['severity'].append(severity)
+                columns['node'].append(node)
+                columns['validationType'].append(validationtype)
+                columns['displayID'].append(result.get('displayID'))
+                columns['batchID'].append(batchid)
+                columns['submittedID'].append(submittedid)
+                columns['kind'].append(KINDS[kind])
+                columns['title'].append(intern(message['title']))
+                columns['description'].append(intern(message['description']))
+    qc_df = pd.DataFrame(columns)
+    for column in CATEGORY_COLUMNS:
+        qc_df[column] = qc_df[column].astype('category')
+    if qc_df['description'].nunique() <= CATEGORY_RATIO * len(qc_df):
+        qc_df['description'] = qc_df['description'].astype('category')
+    return qc_df
+
+
+def memoryReport(qc_df):
+    # Deep memory use and dtype of each column, plus a total row
+    report = pd.DataFrame({'dtype': qc_df.dtypes.astype(str), 'bytes': qc_df.memory_usage(deep=True, index=False)})
+    report.loc['total'] = ['', report['bytes'].sum()]
+    return report
+
+
+class QCIndex:
+    # Row positions of a flattened QC table grouped by each of INDEX_COLUMNS, built once per submission so
+    # picking a different title or severity is a dictionary lookup instead of a scan of every message.
+    def __init__(self, qc_df):
+        self.qc_df = qc_df
+        self.positions = {}
+        for column in INDEX_COLUMNS:
+            self.positions[column] = qc_df.groupby(column, observed=True, sort=False).indices
+
+    def rows(self, **filters):
+        # Sorted row positions matching every filter, e.g. rows(title='Missing value', kind='Error')
+        selected = None
+        for column, value in filters.items():
+            if value is None:
+                continue
+            found = self.positions[column].get(value, np.array([], dtype=np.intp))
+            selected = found if selected is None else np.intersect1d(selected, found, assume_unique=True)
+        if selected is None:
+            return np.arange(len(self.qc_df))
+        return np.sort(selected)
+
+    def select(self, **filters):
+        # The rows of the table matching every filter, in their original order
+        return self.qc_df.iloc[self.rows(**filters)]
+
+    def values(self, column):
+        # Distinct values of an indexed column
+        return list(self.positions[column].keys())
+
+
+def normalizeDescriptions(descriptions):
+    # Vectorized bracketParse over a Series of descriptions.  The same few message templates repeat across
+    # thousands of records, so only unique strings that haven't been seen before are run through the regex.
+    # Descriptions without a ] are passed through unchanged.
+    unique = pd.Series(pd.unique(descriptions), dtype=object).dropna()
+    with _normalized_lock:
+        if len(_normalized) > NORMALIZED_MAX:
+            _normalized.clear()
+        new = unique[~unique.isin(_normalized.keys())]
+        if len(new) > 0:
+            _normalized.update(zip(new, new.str.extract(MESSAGE_PATTERN, expand=False).fillna(new)))
+        mapping = dict((description, _normalized[description]) for description in unique)
+    return descriptions.map(mapping)
+
+def bracketParse(parsethis):
+    # Single description version of normalizeDescriptions
+    match = re.match(MESSAGE_PATTERN, parsethis)
+    if match is None:
+        return parsethis
+    return match.group(1)
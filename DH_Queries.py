@@ -14,8 +14,9 @@ mutation CreateBatch(
 """
 
 list_sub_query = """
-query ListSubmissions($status: [String]){
-  listSubmissions(status: $status){
+query ListSubmissions($status: [String], $first: Int, $offset: Int){
+  listSubmissions(status: $status, first: $first, offset: $offset){
+    total
     submissions{
       _id
       name
@@ -253,3 +254,29 @@ query ListBatches(
 }
 """
 
+
+# Batch specs for DH_Client.batchQuery.  args maps each field argument to its GraphQL type.
+released_data_batch = {
+    'field': 'retrieveReleasedDataByID',
+    'args': {'submissionID': 'String!', 'nodeType': 'String!', 'nodeID': 'String!'},
+    'selection': """{
+    submissionID
+    status
+    dataCommons
+    dataCommonsDisplayName
+    studyID
+    nodeType
+    nodeID
+    props
+}"""
+}
+
+get_submission_batch = {
+    'field': 'getSubmission',
+    'args': {'_id': 'ID!'},
+    'selection': """{
+    _id
+    name
+    dataCommons
+}"""
+}
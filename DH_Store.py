@@ -0,0 +1,353 @@
+# Server side data the Dash dashboard shares between callbacks.  FrameStore keeps DataFrames so only the key
+# returned by put() goes into dcc.Store, and submissionSnapshot() loads everything shown about a submission once.
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+import pandas as pd
+import DH_Client as dhc
+import DH_Queries as dhq
+import DH_QC as dqc
+
+# How many frames are kept before the least recently used ones are dropped
+MAX_FRAMES = 64
+# How many submission snapshots are kept before the least recently used ones are dropped.  Each can hold a
+# submission's whole QC table, so this is much lower than MAX_FRAMES.
+MAX_SNAPSHOTS = 8
+# How long (seconds) frames and progress messages live in a shared diskcache
+SHARED_TTL = 3600
+# With a shared diskcache one process at a time builds a submission's QC index.  Its claim lapses after
+# BUILD_CLAIM_TTL seconds unless renewed, which it is every BUILD_CLAIM_RENEW seconds while the build runs.
+# The other processes check every BUILD_POLL seconds for the index, for at most BUILD_WAIT seconds.
+BUILD_CLAIM_TTL = 30
+BUILD_CLAIM_RENEW = 10
+BUILD_POLL = 0.5
+BUILD_WAIT = 600
+
+# diskcache.Cache shared with background callback processes, see useDiskcache()
+_shared = None
+
+
+def useDiskcache(cache):
+    # Keeps frames and progress messages in cache as well, so background callbacks running in other
+    # processes can read and write them
+    global _shared
+    _shared = cache
+
+
+# Every FrameStore, so _afterFork() can give each one a new lock
+_framestores = weakref.WeakSet()
+
+
+class FrameStore:
+    # Frames are shared between callbacks, so treat what get() returns as read only
+    def __init__(self, max_frames=MAX_FRAMES):
+        self.max_frames = max_frames
+        self.frames = OrderedDict()
+        self.lock = threading.Lock()
+        _framestores.add(self)
+
+    def put(self, frame):
+        key = uuid.uuid4().hex
+        self._remember(key, frame)
+        if _shared is not None:
+            _shared.set(('frame', key), frame, expire=SHARED_TTL)
+        return key
+
+    def _remember(self, key, frame):
+        with self.lock:
+            self.frames[key] = frame
+            while len(self.frames) > self.max_frames:
+                self.frames.popitem(last=False)
+
+    def get(self, key):
+        # None if the key was never handed out, was evicted, or came from before a server restart
+        with self.lock:
+            frame = self.frames.get(key)
+            if frame is not None:
+                self.frames.move_to_end(key)
+                return frame
+        if _shared is None or key is None:
+            return None
+        # Put there by another process
+        frame = _shared.get(('frame', key))
+        if frame is not None:
+            self._remember(key, frame)
+        return frame
+
+    def memory(self):
+        # Deep size in bytes of the frames held in this process
+        with self.lock:
+            frames = list(self.frames.values())
+        return sum(int(frame.memory_usage(deep=True).sum()) for frame in frames)
+
+    def drop(self, key):
+        with self.lock:
+            self.frames.pop(key, None)
+        if _shared is not None:
+            _shared.delete(('frame', key))
+
+
+_progress = {}
+_progress_lock = threading.Lock()
+
+
+def progressReporter(key, label):
+    # Returns a fetchAll progress callback that records "label: n of m pages" under key for progressFor()
+    def report(done, total):
+        if done >= total:
+            clearProgress(key)
+            return
+        message = f"{label}: {done} of {total} pages"
+        if _shared is not None:
+            _shared.set(('progress',) + key, message, expire=SHARED_TTL)
+        with _progress_lock:
+            _progress[key] = message
+    return report
+
+
+def progressFor(key):
+    # Progress message for a fetch that is still running, None if there isn't one
+    with _progress_lock:
+        message = _progress.get(key)
+    if message is None and _shared is not None:
+        message = _shared.get(('progress',) + key)
+    return message
+
+
+def clearProgress(key):
+    with _progress_lock:
+        _progress.pop(key, None)
+    if _shared is not None:
+        _shared.delete(('progress',) + key)
+
+
+# How long (seconds) a submission snapshot is reused before the next selection reloads it
+SNAPSHOT_TTL = 60
+
+
+class SubmissionSnapshot:
+    # Everything the dashboard shows about one submission, fetched with one concurrent load:
+    #   stats    submissionStats entries, one per node type
+    #   summary  aggregatedSubmissionQCResults (all severities), None if the submission has no QC results
+    #   details  every submissionQCResults record (all severities)
+    #   batches  listBatches entries, None if there are no batches
+    # With lazy, details is only fetched the first time it is used.  The dashboard does that so its
+    # background callbacks, not the web workers, pay for the biggest query.
+    # details is dropped once it has been flattened into the QC index.
+    # version fingerprints stats and summary.  The QC index is only built once per version: a reloaded
+    # snapshot takes it over from the one it replaces, and with useDiskcache() it is shared with other processes.
+    def __init__(self, tier, subid, lazy=False):
+        self.tier = tier
+        self.subid = subid
+        self.lock = threading.Lock()
+        self._details = None
+        self._qc = None
+        self._qcindex = None
+        loaders = [(self.loadStats,), (self.loadSummary,), (self.loadBatches,)]
+        if not lazy:
+            loaders.append((self.loadDetails,))
+        results = list(dhc.fanOut(lambda loader: loader(), loaders, len(loaders)))
+        self.stats, self.summary, self.batches = results[:3]
+        if not lazy:
+            self._details = self.checkDetails(results[3])
+        self.version = hashlib.sha1(json.dumps([self.stats, self.summary], sort_keys=True, default=str).encode()).hexdigest()
+        self.loaded = time.monotonic()
+
+    @property
+    def details(self):
+        # Only fetched by the process building the QC index, see sharedIndex()
+        with self.lock:
+            if self._details is None:
+                self._details = self.checkDetails(self.loadDetails())
+            return self._details
+
+    @property
+    def qc(self):
+        # details flattened to one row per error/warning message, see DH_QC.flattenQCResults
+        return self.qcIndex.qc_df
+
+    @property
+    def qcIndex(self):
+        # QCIndex over qc, so switching titles or severities in the dashboard is a lookup
+        with self.lock:
+            if self._qcindex is None and _shared is not None:
+                self.adopt(_shared.get(('qcindex', self.tier, self.subid, self.version)))
+            if self._qcindex is not None:
+                return self._qcindex
+        if _shared is not None:
+            return self.sharedIndex()
+        return self.buildIndex()
+
+    def buildIndex(self):
+        details = self.details
+        with self.lock:
+            if self._qcindex is None:
+                self.adopt(dqc.QCIndex(dqc.flattenQCResults(details)))
+                if _shared is not None:
+                    _shared.set(('qcindex', self.tier, self.subid, self.version), self._qcindex, expire=SHARED_TTL)
+            return self._qcindex
+
+    def sharedIndex(self):
+        # Background callbacks started by the same selection all want the index.  The first to claim the build
+        # fetches the details while the rest wait for the index to show up in the shared cache.  Dash kills a
+        # job when the selection changes, so the claim is short and renewed while the build runs; once a killed
+        # builder's claim lapses a waiting process takes over.
+        key = ('qcindex', self.tier, self.subid, self.version)
+        claim = ('qcbuild', self.tier, self.subid, self.version)
+        deadline = time.monotonic() + BUILD_WAIT
+        while True:
+            qcindex = _shared.get(key)
+            if qcindex is not None:
+                with self.lock:
+                    if self._qcindex is None:
+                        self.adopt(qcindex)
+                    return self._qcindex
+            claimed = _shared.add(claim, os.getpid(), expire=BUILD_CLAIM_TTL)
+            if claimed or time.monotonic() > deadline:
+                break
+            time.sleep(BUILD_POLL)
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(BUILD_CLAIM_RENEW):
+                _shared.touch(claim, expire=BUILD_CLAIM_TTL)
+        if claimed:
+            threading.Thread(target=renew, daemon=True).start()
+        try:
+            return self.buildIndex()
+        finally:
+            stop.set()
+            if claimed:
+                _shared.delete(claim)
+
+    def adopt(self, qcindex):
+        # Takes over a QC index built for the same version, ignores None.  The raw details aren't needed after that.
+        if qcindex is not None:
+            self._qcindex = qcindex
+            self._qc = qcindex.qc_df
+            self._details = None
+
+    def checkDetails(self, details):
+        if isinstance(details, dhc.PageError):
+            # A submission without QC results can fail the detail query, anything else is a real failure
+            if self.summary is not None:
+                raise details
+            details = []
+        return details
+
+    def loadStats(self):
+        res = dhc.apiQuery(self.tier, dhq.submission_stats_query, {'id': self.subid})
+        return res['data']['submissionStats']['stats']
+
+    def loadSummary(self):
+        queryvars = {"submissionID":self.subid, "severity":"All", "first":-1, "offset":0, "sortDirection": "desc", "orderBy": "displayID"}
+        res = dhc.apiQuery(self.tier, dhq.summaryQuery, queryvars)
+        if res['data']['aggregatedSubmissionQCResults']['total'] == None:
+            return None
+        return res['data']['aggregatedSubmissionQCResults']['results']
+
+    def loadDetails(self):
+        queryvars = {"id": self.subid, "severities":"All", "orderBy":"displayID", "sortDirection":"desc"}
+        key = ('qc', self.tier, self.subid)
+        try:
+            return dhc.fetchAll(self.tier, dhq.detailedQCQuery, queryvars, 'submissionQCResults', progress=progressReporter(key, "Loading QC results"))['results']
+        except dhc.PageError as e:
+            return e
+        finally:
+            clearProgress(key)
+
+    def loadBatches(self):
+        queryvars = {"submissionID":self.subid, "orderBy":"createdAt", "sortDirection":"DESC"}
+        res = dhc.apiQuery(self.tier, dhq.list_batch_query, queryvars)
+        if res['data']['listBatches']['total'] == None:
+            return None
+        return res['data']['listBatches']['batches']
+
+    def summaryFor(self, severity):
+        # Aggregated QC results for one severity, None if there are none
+        if self.summary is None:
+            return None
+        return [entry for entry in self.summary if entry['severity'] == severity]
+
+
+_snapshots = OrderedDict()
+_snapshots_lock = threading.Lock()
+
+
+def payloadSize(value):
+    # Approximate deep size in bytes of a decoded JSON payload
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size = size + sum(payloadSize(key) + payloadSize(item) for key, item in value.items())
+    elif isinstance(value, list):
+        size = size + sum(payloadSize(item) for item in value)
+    return size
+
+
+def memoryReport(framestore=None):
+    # One row per cached snapshot with the size of what it holds of its QC results: the raw details records
+    # until they are flattened, then the QC table.  Plus a row for framestore if given.
+    with _snapshots_lock:
+        snapshots = list(_snapshots.values())
+    rows = []
+    for snapshot in snapshots:
+        details = snapshot._details
+        qc = snapshot._qc
+        size = 0
+        if details is not None:
+            size = size + payloadSize(details)
+        if qc is not None:
+            size = size + int(qc.memory_usage(deep=True).sum())
+        rows.append({'tier': snapshot.tier, 'submission': snapshot.subid, 'records': 0 if details is None else len(details),
+                     'messages': 0 if qc is None else len(qc), 'bytes': size})
+    if framestore is not None:
+        rows.append({'tier': '', 'submission': 'frame store', 'records': 0, 'messages': len(framestore.frames), 'bytes': framestore.memory()})
+    return pd.DataFrame(rows, columns=['tier', 'submission', 'records', 'messages', 'bytes'])
+
+
+def _afterFork():
+    # A forked child (such as a Dash background callback) may have been forked while another thread held one
+    # of these locks, so it starts with fresh ones.  The data they guard is kept.
+    global _progress_lock, _snapshots_lock
+    _progress_lock = threading.Lock()
+    _snapshots_lock = threading.Lock()
+    for framestore in list(_framestores):
+        framestore.lock = threading.Lock()
+    for snapshot in _snapshots.values():
+        snapshot.lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_afterFork)
+
+
+def submissionSnapshot(tier, subid, ttl=SNAPSHOT_TTL, lazy=False):
+    # Every callback that fires on a submission selection asks for the same snapshot, only the first
+    # one loads it and the rest wait for and share that load.
+    tier = dhc.normalizeTier(tier)
+    key = ('snapshot', tier, subid)
+    with _snapshots_lock:
+        snapshot = _snapshots.get(key)
+        if snapshot is not None and time.monotonic() - snapshot.loaded < ttl:
+            _snapshots.move_to_end(key)
+            return snapshot
+
+    def load():
+        snapshot = SubmissionSnapshot(tier, subid, lazy)
+        with _snapshots_lock:
+            previous = _snapshots.get(key)
+            if previous is not None and previous.version == snapshot.version:
+                # Nothing has changed since the last load, keep the QC index that was already built
+                snapshot.adopt(previous._qcindex)
+            _snapshots[key] = snapshot
+            _snapshots.move_to_end(key)
+            while len(_snapshots) > MAX_SNAPSHOTS:
+                _snapshots.popitem(last=False)
+        return snapshot
+    return dhc.singleFlight(key, load)
@@ -1,25 +1,7 @@
 import requests
-import os
 import DH_Queries as dhq
+import DH_Client as dhc
 
-def apiQuery(url, query, variables):
-    token = os.environ['DEV2API']
-    headers = {"Authorization": f"Bearer {token}"}
-    
-
-    try:
-        if variables is None:
-            result = requests.post(url = url, headers = headers, json={"query": query})
-        else:
-            result = requests.post(url = url, headers = headers, json = {"query":query, "variables":variables})
-        if result.status_code == 200:
-            return result.json()
-        else:
-            print(f"Error: {result.status_code}")
-            return result.content
-    except requests.exceptions.HTTPError as e:
-        return(f"HTTP Error: {e}")
-    
 def awsFileUpload2(filedict, signedurl, datadir):
     headers = {'Content-Type': 'text/tab-separated-values'}
     sendthis = []
@@ -76,13 +58,13 @@ def urlComp(batchobject):
     
 
 #def main():
-dev2 = 'https://hub-dev2.datacommons.cancer.gov/api/graphql'
+tier = 'DEV2'
 submission_name = 'Jupyter Demo 2'
 datadir = "/home/pihl/testdata/"
 
 #Get the submissionID
 statusvariables = {"status":"All"}
-list_sub_res = apiQuery(dev2, dhq.list_sub_query, statusvariables)
+list_sub_res = dhc.apiQuery(tier, dhq.list_sub_query, statusvariables)
 
 for submission in list_sub_res['data']['listSubmissions']['submissions']:
     if submission['name'] == submission_name:
@@ -98,7 +80,7 @@ metadatafiles = [{"fileName":"PDXNet_participant.tsv", "size": 2106 }, {"fileNam
 
 #Create the batch
 create_batch_variables = {"submissionID": submissionid, "type":subtype, "file":metadatafiles}
-create_batch_res = apiQuery(dev2, dhq.create_batch_query, create_batch_variables)
+create_batch_res = dhc.apiQuery(tier, dhq.create_batch_query, create_batch_variables)
 #print(create_batch_res)
 batchid = create_batch_res['data']['createBatch']['_id']
 
@@ -140,6 +122,6 @@ for entry in metadatafiles:
 # Update the batch
 print("Sending update")
 update_variables = {'batchID':batchid, 'files':file_upload_result}
-update_res = apiQuery(dev2, dhq.update_batch_query, update_variables)
+update_res = dhc.apiQuery(tier, dhq.update_batch_query, update_variables)
 print(batchid)
 print(update_res)
\ No newline at end of file
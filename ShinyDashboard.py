@@ -1,8 +1,9 @@
 from shiny import Inputs, Outputs, Session, ui, render,reactive, App
-import requests
 import pandas as pd
 import DH_Queries as dhq
-import os
+import DH_Client as dhc
+import DH_QC as dqc
+import DH_Nodes as dhn
 from ShinyDashboardModules import dropdown_ui, df_table
 from datetime import datetime, timezone
 from pytz import timezone as tz
@@ -10,6 +11,10 @@ from shinywidgets import render_widget, output_widget
 import plotly.express as px
 
 
+# Reactives for the same submission send identical queries, cache the responses so each is fetched once.
+# The disk cache lets a restarted dashboard start warm and fall back to the last known data if the API is down.
+dhc.enableCache(diskfile=dhc.DISK_CACHE_FILE)
+
 ### Useful links
 # https://shiny.posit.co/py/gallery/
 # https://shiny.posit.co/py/templates/dashboard/
@@ -20,53 +25,6 @@ import plotly.express as px
 #       Subroutines                   #
 #                                     #
 #######################################
-def apiQuery(tier, query, variables, queryprint = False):
-    token = None
-    if tier == 'DEV2':
-        url = 'https://hub-dev2.datacommons.cancer.gov/api/graphql'
-        token = os.environ['DEV2API']
-    elif tier == 'STAGE':
-        url = 'https://hub-stage.datacommons.cancer.gov/api/graphql'
-        token = os.environ['STAGEAPI']
-    elif tier == 'PROD':
-        url = 'https://hub.datacommons.cancer.gov/api/graphql'
-        token = os.environ['PRODAPI']
-    elif tier == 'BUPKIS':
-        return("The Bupkis tier has been selected")
-    elif tier == None:
-        return("No tier specified")
-
-        headers = {"Authorization": f"Bearer {token}"}
-    if token is not None:
-        try:
-            if variables is None:
-                result = requests.post(url = url, headers = headers, json={"query": query})
-                if queryprint:
-                    print(query)
-            else:
-                result = requests.post(url = url, headers = headers, json = {"query":query, "variables":variables})
-                if queryprint:
-                    print(query)
-                    print(variables)
-            if result.status_code == 200:
-                return result.json()
-            else:
-                print(f"Error: {result.status_code}")
-                return result.content
-        except requests.exceptions.HTTPError as e:
-            return(f"HTTP Error: {e}")
-
-
-
-def bracketParse(parsethis):
-    first = parsethis.split("]")
-    errorstring = first[1]
-    if "[" in errorstring:
-        second = errorstring.split("[")
-        return second[0]
-    else:
-        return errorstring
-    
 def elapsedTime(submission_df):
     days = []
     for index, row in submission_df.iterrows():
@@ -162,7 +120,7 @@ def server(input, output, session):
     @reactive.calc
     @reactive.event(input.tierSelect, ignore_none=True, ignore_init=True)
     def studyDF():
-        studyjson = apiQuery(input.tierSelect(), dhq.org_query, None, False)
+        studyjson = dhc.apiQuery(input.tierSelect(), dhq.org_query, None, False)
         study_df = pd.DataFrame(studyjson['data']['getMyUser']['studies'])
         return study_df
     
@@ -171,46 +129,40 @@ def server(input, output, session):
     @reactive.event(input.studySelect, ignore_none=True, ignore_init=True)
     def submissionDF():
         getSubTypes = list(input.subStatus())
-        fulljson = apiQuery(input.tierSelect(), dhq.list_sub_query, {"status":getSubTypes})
+        fulljson = dhc.apiQuery(input.tierSelect(), dhq.list_sub_query, {"status":getSubTypes})
         sub_df = pd.DataFrame(fulljson['data']['listSubmissions']['submissions'])
         sub_df = elapsedTime(sub_df)
         return sub_df
     
+    # INDEXED ERROR INFORMATION
+    # Fetched and indexed once per submission, picking a different error is then just a lookup
+    @reactive.calc
+    @reactive.event(input.submissionSelect, ignore_init=True, ignore_none=True)
+    async def qcIndex():
+        errorvars = {"id": input.submissionSelect(), "severities":"All", "orderBy":"displayID", "sortDirection":"desc"}
+        fulljson = await dhc.fetchAllAsync(input.tierSelect(), dhq.detailedQCQuery, errorvars, 'submissionQCResults')
+        return dqc.QCIndex(dqc.flattenQCResults(fulljson['results']))
+
     # FULL ERROR INFORMATION
     @reactive.calc
     @reactive.event(input.errorSelect, ignore_init=True, ignore_none=True)
-    def errorDF():
-        errorvars = {"id": input.submissionSelect(), "severities":"All", "first": -1, "offset": 0, "orderBy":"displayID", "sortDirection":"desc"}
-        fulljson = apiQuery(input.tierSelect(), dhq.detailedQCQuery, errorvars)
-        columns = ['type', 'title', 'description']
-        error_df = pd.DataFrame(columns=columns)
-        for result in fulljson['data']['submissionQCResults']['results']:
-            for error in result['errors']:
-                if error['title'] == input.errorSelect():
-                    desc = bracketParse(error['description'])
-                    error_df.loc[len(error_df)] = {'type': 'Error', 'title': error['title'], 'description': desc}
+    async def errorDF():
+        index = await qcIndex()
+        selected = index.select(kind='Error', title=input.errorSelect())
+        error_df = pd.DataFrame({'type': 'Error', 'title': selected['title'], 'description': dqc.normalizeDescriptions(selected['description'])},
+                                columns=['type', 'title', 'description'])
         return error_df
     
     # PROCESSED SUMMARY ERROR INFORMATION
     # This takes the fine grained error info and counts the description
     @reactive.calc
     @reactive.event(input.submissionSelect)
-    def processedErrorSummaryDF():
-        columns = ['severity','node', 'title', 'description']
-        working_df = pd.DataFrame(columns=columns)
-        errorvars = {"id": input.submissionSelect(), "severities":"All", "first": -1, "offset": 0, "orderBy":"displayID", "sortDirection":"desc"}
-        error_res = apiQuery(input.tierSelect(), dhq.detailedQCQuery, errorvars)
-        working_df.loc[len(working_df)] = {'type':'Check', 'title':'QC Results Query', 'description':'Initial Entry'}
-        if error_res['data']['submissionQCResults']['total'] > 0:
-            working_df.loc[len(working_df)] = {'type':'Check', 'title':'QC Results Query', 'description':'More than 0 errors'}
-            for result in error_res['data']['submissionQCResults']['results']:
-                for error in result['errors']:
-                    message = bracketParse(error['description'])
-                    working_df.loc[len(working_df)] = {'severity':result['severity'], 
-                                                       'node': result['type'], 
-                                                       'title': error['title'], 
-                                                       'description': message}
-            errorSummary_df = working_df.groupby(['node', 'title','description']).size().reset_index().rename(columns={0:'count'}).sort_values(by='count', ascending=False)
+    async def processedErrorSummaryDF():
+        index = await qcIndex()
+        working_df = index.select(kind='Error')[['severity', 'node', 'title', 'description']]
+        if len(working_df) > 0:
+            working_df = working_df.assign(description=dqc.normalizeDescriptions(working_df['description']))
+            errorSummary_df = working_df.groupby(['node', 'title','description'], observed=True).size().reset_index().rename(columns={0:'count'}).sort_values(by='count', ascending=False)
         else:
             errorSummary_df = pd.DataFrame({'severity': ['None'],
                                             'node': ['None'], 
@@ -223,9 +175,9 @@ def server(input, output, session):
     # VERY high level, no detailed descriptions
     @reactive.calc
     @reactive.event(input.submissionSelect, ignore_init=True, ignore_none=True)
-    def errorSummaryDF():
+    async def errorSummaryDF():
         vars = {"id": input.submissionSelect(), "severities":"All", "first": -1, "offset": 0, "orderBy":"displayID", "sortDirection":"desc"}
-        res = apiQuery(input.tierSelect(), dhq.summaryQuery, vars)
+        res = await dhc.apiQueryAsync(input.tierSelect(), dhq.summaryQuery, vars)
         if 'data' in res:
             if res['data']['aggregatedSubmissionQCResults']['total'] > 0:
                 summary_df = pd.DataFrame(res['data']['aggregatedSubmissionQCResults']['results'])
@@ -238,13 +190,13 @@ def server(input, output, session):
     # DATA INFORMATION
     @reactive.calc
     @reactive.event(input.dataSelect, ignore_init=True, ignore_none=True)
-    def dataDF():
-        queryvars = {'_id':input.submissionSelect(), 'nodeType':input.dataSelect(), 'status':'All', 'first':-1, 'offset':0, 'orderBy':'studyID', 'sortDirection':'desc'}
-        data_res = apiQuery(input.tierSelect(), dhq.submission_nodes_query, queryvars)
-        if data_res['data']['getSubmissionNodes']['total'] == None:
+    async def dataDF():
+        queryvars = {'_id':input.submissionSelect(), 'nodeType':input.dataSelect(), 'status':'All', 'orderBy':'nodeID', 'sortDirection':'desc'}
+        data_res = await dhc.fetchAllAsync(input.tierSelect(), dhq.submission_nodes_query, queryvars, 'getSubmissionNodes')
+        if data_res['total'] == None:
             data_df = pd.DataFrame({'Data': ['No Data Found']})
         else:
-            data_df = pd.DataFrame(data_res['data']['getSubmissionNodes']['nodes'])
+            data_df = dhn.nodeTable(data_res)
         return data_df
         
 
@@ -259,9 +211,9 @@ def server(input, output, session):
     #@render.text
     #@reactive.event(input.tierSelect, ignore_init=True, ignore_none=True)
     #def studyCall():
-        #jsonthing = apiQuery(input.tierSelect(), dhq.list_sub_query, {"status":["All"]} )
+        #jsonthing = dhc.apiQuery(input.tierSelect(), dhq.list_sub_query, {"status":["All"]} )
         #queryvars = {"submissionID":input.submissionSelect(), "severity":"All", "first":-1, "offset":0, "sortDirection": "desc", "orderBy": "displayID"}
-        #jsonthing = apiQuery(input.tierSelect(), dhq.summaryQuery, queryvars)
+        #jsonthing = dhc.apiQuery(input.tierSelect(), dhq.summaryQuery, queryvars)
         #return str(jsonthing)
         #jsonthing = ''.join(input.subSelect())
         #jsonthing = list(input.subSelect())
@@ -279,17 +231,17 @@ def server(input, output, session):
         return render.DataGrid(submissionDF(), selection_mode='row', filters=True)
     
     @render.data_frame
-    def errorInfo():
-        return render.DataGrid(errorDF(), selection_mode='row', filters=True)
+    async def errorInfo():
+        return render.DataGrid(await errorDF(), selection_mode='row', filters=True)
         
     
     @render.data_frame
-    def errorSummaryInfo():
-        return render.DataGrid(processedErrorSummaryDF(), selection_mode='row', filters=True)
+    async def errorSummaryInfo():
+        return render.DataGrid(await processedErrorSummaryDF(), selection_mode='row', filters=True)
     
     @render.data_frame
-    def dataInfo():
-        return render.DataGrid(dataDF(), selection_mode='row', filters=True)
+    async def dataInfo():
+        return render.DataGrid(await dataDF(), selection_mode='row', filters=True)
     
     
     ####################################
@@ -323,10 +275,10 @@ def server(input, output, session):
         
     @reactive.effect    
     @reactive.event(input.submissionSelect, ignore_init=True)
-    def updateErrors():
+    async def updateErrors():
         error_items = {}
         queryvars = {"submissionID":input.submissionSelect(), "severity":"All", "first":-1, "offset":0, "sortDirection": "desc", "orderBy": "displayID"}
-        selector_res = apiQuery(input.tierSelect(), dhq.summaryQuery, queryvars)
+        selector_res = await dhc.apiQueryAsync(input.tierSelect(), dhq.summaryQuery, queryvars)
         if selector_res['data']['aggregatedSubmissionQCResults']['total'] == None:
             error_items =  {"No Errors": "No Errors"}
         else:
@@ -341,10 +293,10 @@ def server(input, output, session):
     
     @reactive.effect
     @reactive.event(input.submissionSelect, ignore_init=True, ignore_none=True)
-    def updateData():
+    async def updateData():
         data_items = {}
         queryvars = {'id':input.submissionSelect()}
-        data_res = apiQuery(input.tierSelect(), dhq.submission_stats_query, queryvars)
+        data_res = await dhc.apiQueryAsync(input.tierSelect(), dhq.submission_stats_query, queryvars)
         if len(data_res['data']['submissionStats']['stats']) > 0:
             for entry in data_res['data']['submissionStats']['stats']:
                 data_items[entry['nodeName']] = entry['nodeName']
@@ -363,10 +315,10 @@ def server(input, output, session):
     
     @render_widget
     @reactive.event(input.submissionSelect)
-    def errorPie():
+    async def errorPie():
         error_pie = px.pie(
             #errorSummaryDF(),
-            processedErrorSummaryDF(),
+            await processedErrorSummaryDF(),
             values='count',
             names='title',
             hole=.3
@@ -0,0 +1,217 @@
+# Keeps a local SQLite mirror of submissions, QC results and submitted nodes so dashboards and scripts can
+# query them without re-downloading.  Each sync only refetches submissions whose updatedAt has moved, and
+# for those only the QC results validated or uploaded since the last sync.
+import argparse
+import json
+import sqlite3
+import pandas as pd
+import DH_Client as dhc
+import DH_Queries as dhq
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    _id TEXT PRIMARY KEY, name TEXT, submitterID TEXT, submitterName TEXT, studyAbbreviation TEXT, studyID TEXT,
+    dbGaPID TEXT, createdAt TEXT, updatedAt TEXT, metadataValidationStatus TEXT, fileValidationStatus TEXT, status TEXT
+);
+CREATE TABLE IF NOT EXISTS qc_results (
+    submissionID TEXT, type TEXT, validationType TEXT, batchID TEXT, displayID TEXT, submittedID TEXT, severity TEXT,
+    uploadedDate TEXT, validatedDate TEXT, errors TEXT, warnings TEXT,
+    PRIMARY KEY (submissionID, type, submittedID, validationType)
+);
+CREATE INDEX IF NOT EXISTS qc_severity ON qc_results (submissionID, severity);
+CREATE INDEX IF NOT EXISTS qc_type ON qc_results (submissionID, type);
+CREATE TABLE IF NOT EXISTS node_types (
+    submissionID TEXT, nodeType TEXT, IDPropName TEXT, properties TEXT,
+    PRIMARY KEY (submissionID, nodeType)
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    submissionID TEXT, nodeType TEXT, nodeID TEXT, status TEXT, props TEXT,
+    PRIMARY KEY (submissionID, nodeType, nodeID)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    submissionID TEXT PRIMARY KEY, updatedAt TEXT, qcWatermark TEXT
+);
+"""
+
+SUBMISSION_COLUMNS = ['_id', 'name', 'submitterID', 'submitterName', 'studyAbbreviation', 'studyID', 'dbGaPID', 'createdAt',
+                      'updatedAt', 'metadataValidationStatus', 'fileValidationStatus', 'status']
+QC_COLUMNS = ['submissionID', 'type', 'validationType', 'batchID', 'displayID', 'submittedID', 'severity',
+              'uploadedDate', 'validatedDate', 'errors', 'warnings']
+
+
+def openMirror(filename):
+    conn = sqlite3.connect(filename)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def qcDate(result):
+    # Most recent thing that happened to a QC result
+    return max(result.get('validatedDate') or '', result.get('uploadedDate') or '')
+
+
+def qcRow(result):
+    row = []
+    for column in QC_COLUMNS:
+        if column in ('errors', 'warnings'):
+            row.append(json.dumps(result[column]))
+        else:
+            row.append(result[column])
+    return row
+
+
+def syncQCResults(conn, tier, subid, watermark, pagesize, verbose):
+    # Walks QC results newest first and stops at the first one older than the watermark.  Results dated the
+    # same as the watermark are read again, since validatedDate has ties and the previous sync may have
+    # stopped partway through them.  Neither validatedDate nor displayID (shared by every result in a batch)
+    # is unique, so pages can repeat or skip results.  If the walk comes up short of total, or the mirror's
+    # count doesn't match the server's total afterwards (results were cleared or the watermark is missing),
+    # the submission's QC results are refetched in full.  fetchAll drops repeated results and checks the rest
+    # against total, falling back to a single first: -1 request, so the refetch is complete or raises PageError.
+    qcvars = {"id": subid, "severities": "All", "orderBy": "validatedDate", "sortDirection": "desc"}
+    fullvars = {"id": subid, "severities": "All", "orderBy": "displayID", "sortDirection": "desc"}
+    newest = watermark
+    total = None
+    rows = []
+    short = False
+    try:
+        for page in dhc.paginate(tier, dhq.detailedQCQuery, qcvars, 'submissionQCResults', pagesize, prefetch=True):
+            total = page['total']
+            stop = False
+            for result in page['results']:
+                if watermark is not None and qcDate(result) < watermark:
+                    stop = True
+                    break
+                rows.append(qcRow(result))
+                if newest is None or qcDate(result) > newest:
+                    newest = qcDate(result)
+            if stop:
+                break
+    except dhc.PageError as e:
+        if total is None:
+            raise
+        # The pages held fewer distinct results than total
+        short = True
+        if verbose >= 2:
+            print(f"{subid}: {e}")
+    conn.executemany(f"INSERT OR REPLACE INTO qc_results VALUES ({', '.join('?' * len(QC_COLUMNS))})", rows)
+    count = conn.execute("SELECT COUNT(*) FROM qc_results WHERE submissionID = ?", (subid,)).fetchone()[0]
+    if short or (total is not None and count != total):
+        if verbose >= 2:
+            print(f"{subid}: mirror has {count} QC results, server has {total}, refetching all")
+        full = dhc.fetchAll(tier, dhq.detailedQCQuery, fullvars, 'submissionQCResults', pagesize)
+        conn.execute("DELETE FROM qc_results WHERE submissionID = ?", (subid,))
+        conn.executemany(f"INSERT OR REPLACE INTO qc_results VALUES ({', '.join('?' * len(QC_COLUMNS))})", [qcRow(result) for result in full['results']])
+        rows = full['results']
+        newest = max([qcDate(result) for result in full['results']], default=None)
+    return len(rows), newest
+
+
+def syncNodes(conn, tier, subid, pagesize):
+    # Nodes carry no dates, so a changed submission gets each node type replaced as a whole
+    stats = dhc.apiQuery(tier, dhq.submission_stats_query, {"id": subid})
+    if not isinstance(stats, dict) or stats.get('data') is None:
+        raise dhc.PageError(f"submissionStats failed for {subid}: {stats}")
+    count = 0
+    for entry in stats['data']['submissionStats']['stats']:
+        nodevars = {'_id': subid, 'nodeType': entry['nodeName'], 'status': 'All', 'orderBy': 'nodeID', 'sortDirection': 'desc'}
+        nodes = dhc.fetchAll(tier, dhq.submission_nodes_query, nodevars, 'getSubmissionNodes', pagesize)
+        conn.execute("DELETE FROM nodes WHERE submissionID = ? AND nodeType = ?", (subid, entry['nodeName']))
+        conn.execute("INSERT OR REPLACE INTO node_types VALUES (?, ?, ?, ?)", (subid, entry['nodeName'], nodes.get('IDPropName'), json.dumps(nodes.get('properties'))))
+        conn.executemany("INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?, ?)",
+                         [(subid, node['nodeType'], node['nodeID'], node['status'], node['props']) for node in nodes['nodes']])
+        count = count + len(nodes['nodes'])
+    return count
+
+
+def sync(conn, tier, status=None, pagesize=dhc.PAGE_SIZE, verbose=0):
+    if status is None:
+        status = ["All"]
+    # listSubmissions takes no orderBy, so the offset order isn't fixed.  fetchAll drops submissions seen
+    # twice and checks the rest against total, falling back to one first: -1 request.
+    submissions = dhc.fetchAll(tier, dhq.list_sub_query, {"status": status}, 'listSubmissions', pagesize)['submissions']
+    conn.executemany(f"INSERT OR REPLACE INTO submissions VALUES ({', '.join('?' * len(SUBMISSION_COLUMNS))})",
+                     [[submission.get(column) for column in SUBMISSION_COLUMNS] for submission in submissions])
+    conn.commit()
+    state = dict((row[0], (row[1], row[2])) for row in conn.execute("SELECT submissionID, updatedAt, qcWatermark FROM sync_state"))
+    changed = [submission for submission in submissions if state.get(submission['_id'], (None, None))[0] != submission['updatedAt']]
+    if verbose >= 1:
+        print(f"{len(submissions)} submissions, {len(changed)} changed since the last sync")
+    for submission in changed:
+        subid = submission['_id']
+        try:
+            qccount, watermark = syncQCResults(conn, tier, subid, state.get(subid, (None, None))[1], pagesize, verbose)
+            nodecount = syncNodes(conn, tier, subid, pagesize)
+        except dhc.PageError as e:
+            # Leave sync_state alone so the submission is picked up again next time
+            conn.rollback()
+            print(f"Unable to sync {subid}, it will be retried on the next sync: {e}")
+            continue
+        conn.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)", (subid, submission['updatedAt'], watermark))
+        conn.commit()
+        if verbose >= 2:
+            print(f"{subid}: {qccount} new QC results, {nodecount} nodes")
+
+
+######## Readers for the dashboards and scripts ########
+
+def readSubmissions(conn, status=None):
+    if status is None:
+        return pd.read_sql_query("SELECT * FROM submissions", conn)
+    return pd.read_sql_query(f"SELECT * FROM submissions WHERE status IN ({', '.join('?' * len(status))})", conn, params=list(status))
+
+
+def readQCResults(conn, subid, severity=None):
+    # errors and warnings come back as the same lists of {title, description} the API returns
+    if severity is None or severity == 'All':
+        qc_df = pd.read_sql_query("SELECT * FROM qc_results WHERE submissionID = ?", conn, params=[subid])
+    else:
+        qc_df = pd.read_sql_query("SELECT * FROM qc_results WHERE submissionID = ? AND severity = ?", conn, params=[subid, severity])
+    qc_df['errors'] = qc_df['errors'].map(json.loads)
+    qc_df['warnings'] = qc_df['warnings'].map(json.loads)
+    return qc_df
+
+
+def readNodePages(conn, subid, nodetype, pagesize=dhc.PAGE_SIZE, status='All'):
+    # Yields pages shaped like the getSubmissionNodes payload so the mirror can stand in for dhc.paginate
+    nodeinfo = conn.execute("SELECT IDPropName, properties FROM node_types WHERE submissionID = ? AND nodeType = ?", (subid, nodetype)).fetchone()
+    if nodeinfo is None:
+        return
+    where = "submissionID = ? AND nodeType = ?"
+    params = [subid, nodetype]
+    if status is not None and status != 'All':
+        where = where + " AND status = ?"
+        params.append(status)
+    total = conn.execute(f"SELECT COUNT(*) FROM nodes WHERE {where}", params).fetchone()[0]
+    cursor = conn.execute(f"SELECT nodeID, nodeType, status, props FROM nodes WHERE {where} ORDER BY nodeID", params)
+    while True:
+        rows = cursor.fetchmany(pagesize)
+        if len(rows) == 0:
+            break
+        yield {'total': total, 'IDPropName': nodeinfo[0], 'properties': json.loads(nodeinfo[1]),
+               'nodes': [{'nodeID': row[0], 'nodeType': row[1], 'status': row[2], 'props': row[3]} for row in rows]}
+
+
+def main(args):
+    tier = args.tier.upper()
+    database = args.database
+    if database is None:
+        database = f"dh_mirror_{tier.lower()}.sqlite"
+    if args.verbose >= 1:
+        print(f"Syncing {tier} into {database}")
+    conn = openMirror(database)
+    sync(conn, tier, args.status, args.pagesize, args.verbose)
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--tier", required=True,  help="System tier.  'stage' or 'prod'")
+    parser.add_argument("-d", "--database", default=None, help="SQLite mirror file, defaults to dh_mirror_<tier>.sqlite")
+    parser.add_argument("-s", "--status", nargs='+', default=None, help="Only mirror submissions in these states, default is all")
+    parser.add_argument("-p", "--pagesize", type=int, default=dhc.PAGE_SIZE, help="Records fetched per page")
+    parser.add_argument('-v', '--verbose', action='count', default=0, help=("Verbosity: -v main section -vv subroutine messages -vvv data returned shown"))
+
+    args = parser.parse_args()
+
+    main(args)
@@ -1,16 +1,19 @@
 from dash import html, dcc, dash_table, Output, Input, State
 import dash
 import dash_bootstrap_components  as dbc
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
 from dash.exceptions import PreventUpdate 
 import plotly.express as px
 import pandas as pd
-import requests
 import DH_Queries as dhq
-import os
+import DH_Client as dhc
+import DH_Store as dhs
+import DH_QC as dqc
+import DH_Nodes as dhn
 from datetime import datetime, timezone
-import time
-import json
-import io
 from pytz import timezone as tz
 
 
@@ -37,6 +40,34 @@ app = dash.Dash(
 )
 app.title ="DH Dashboard"
 
+# Every selection fires several callbacks that send the same queries, cache the responses so each is fetched once.
+# The disk cache lets a restarted dashboard start warm and fall back to the last known data if the API is down.
+dhc.enableCache(diskfile=dhc.DISK_CACHE_FILE)
+
+# The study and submission tables stay on the server, the dcc.Store components only hold their keys
+frames = dhs.FrameStore()
+
+# With diskcache (and the multiprocess and psutil packages Dash's DiskcacheManager also needs) installed the
+# QC detail callbacks run as background jobs in their own processes, so a big submission can't tie up or time
+# out a web worker.  Without them they run in the request as before.
+JOB_CACHE_DIR = './dh_dash_jobs'
+background_manager = None
+if diskcache is not None:
+    jobcache = diskcache.Cache(JOB_CACHE_DIR)
+    try:
+        background_manager = dash.DiskcacheManager(jobcache)
+    except ImportError as e:
+        print(f"Background callbacks are off, {e}")
+    else:
+        dhs.useDiskcache(jobcache)
+
+
+def backgroundOptions(*cancel):
+    # Callback arguments that make it a background job, cancelled when any of the cancel inputs change
+    if background_manager is None:
+        return {}
+    return {'background': True, 'manager': background_manager, 'cancel': list(cancel)}
+
 
 
 #######################################
@@ -44,41 +75,32 @@ app.title ="DH Dashboard"
 #       Subroutines                   #
 #                                     #
 #######################################
-def apiQuery(tier, query, variables, queryprint = False):
-    if tier == 'DEV2':
-        url = 'https://hub-dev2.datacommons.cancer.gov/api/graphql'
-        token = os.environ['DEV2API']
-    elif tier == 'STAGE':
-        url = 'https://hub-stage.datacommons.cancer.gov/api/graphql'
-        token = os.environ['STAGEAPI']
-    elif tier == 'PROD':
-        url = 'https://hub.datacommons.cancer.gov/api/graphql'
-        token = os.environ['PRODAPI']
-    elif tier == None:
-        return("No tier specified")
-
-    headers = {"Authorization": f"Bearer {token}"}
-    
-    try:
-        if variables is None:
-            result = requests.post(url = url, headers = headers, json={"query": query})
-            if queryprint:
-                print(query)
-        else:
-            result = requests.post(url = url, headers = headers, json = {"query":query, "variables":variables})
-            if queryprint:
-                print(query)
-                print(variables)
-        if result.status_code == 200:
-            return result.json()
-        else:
-            print(f"Error: {result.status_code}")
-            return result.content
-    except requests.exceptions.HTTPError as e:
-        return(f"HTTP Error: {e}")
+def loadStudies(tier):
+    studyjson = dhc.apiQuery(tier, dhq.org_query, None)
+    columns = ["_id","studyAbbreviation"]
+    study_df = pd.DataFrame(columns=columns)
+    for entry in studyjson['data']['getMyUser']['studies']:
+        study_df.loc[len(study_df)] = entry
+    return study_df.reset_index()
+
+
+def loadSubmissions(tier):
+    #Get a list of the submissions
+    subjson = dhc.apiQuery(tier, dhq.list_sub_query, {"status":["All"]})
+    sub_df = pd.DataFrame(subjson['data']['listSubmissions']['submissions'])
+    #Create the elapsedTime column
+    sub_df = elapsedTime(sub_df)
+    return sub_df.reset_index()
+
+
+def storedFrame(key, loader, tier):
+    # Falls back to reloading if the key has been evicted or the server restarted since it was handed out
+    frame = frames.get(key)
+    if frame is None:
+        frame = loader(tier)
+    return frame
 
 
- 
 def elapsedTime(submission_df):
     days = []
     for index, row in submission_df.iterrows():
@@ -92,16 +114,6 @@ def elapsedTime(submission_df):
     return submission_df
 
 
-def bracketParse(parsethis):
-    first = parsethis.split("]")
-    errorstring = first[1]
-    if "[" in errorstring:
-        second = errorstring.split("[")
-        return second[0]
-    else:
-        return errorstring
-
-
 def updateAggregation(df):
     filelist = []
     columns = ['title', 'description', 'count']
@@ -116,6 +128,114 @@ def updateAggregation(df):
         agg_df.loc[len(agg_df)] = {'title': 'Updating existing data', 'description': 'File update', 'count': len(filelist)}
     return agg_df
 
+
+# Rows sent to the browser per table page
+PAGE_SIZE = 25
+FILTER_OPERATORS = [['ge ', '>='], ['le ', '<='], ['lt ', '<'], ['gt ', '>'], ['ne ', '!='], ['eq ', '='], ['contains '], ['datestartswith ']]
+
+
+def splitFilterPart(filter_part):
+    # Turns one clause of a DataTable filter_query, e.g. {status} eq "New", into (column, operator, value).
+    # value is always the string typed, filterFrame decides from the column whether it is a number.
+    for operator_type in FILTER_OPERATORS:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+                value_part = value_part.strip()
+                if len(value_part) == 0:
+                    return None, None, None
+                quote = value_part[0]
+                if quote == value_part[-1] and quote in ("'", '"', '`'):
+                    value = value_part[1:-1].replace('\\' + quote, quote)
+                else:
+                    value = value_part
+                return name, operator_type[0].strip(), value
+    return None, None, None
+
+
+def filterFrame(frame, filter_query):
+    if not filter_query:
+        return frame
+    for filter_part in filter_query.split(' && '):
+        column, operator, value = splitFilterPart(filter_part)
+        if column not in frame.columns:
+            continue
+        if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+            frame = frame.loc[compare(frame[column], operator, value)]
+        elif operator == 'contains':
+            frame = frame.loc[frame[column].astype(str).str.contains(value, regex=False)]
+        elif operator == 'datestartswith':
+            frame = frame.loc[frame[column].astype(str).str.startswith(value)]
+    return frame
+
+
+def compare(series, operator, value):
+    # Numeric columns are compared as numbers when the value is one, everything else as text, so IDs
+    # that look like numbers still match
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        try:
+            return getattr(series, operator)(float(value))
+        except ValueError:
+            pass
+    return getattr(series.astype(str), operator)(value)
+
+
+def sortKey(series):
+    # Object columns holding a mix of types (decoded node props can have ints and strings in one column)
+    # can't be compared, so they sort as text
+    if series.dtype == object and pd.api.types.infer_dtype(series, skipna=True) in ('mixed', 'mixed-integer'):
+        return series.astype(str)
+    return series
+
+
+def tablePage(frame, page_current, page_size, sort_by, filter_query):
+    # Returns only the rows (and their tooltips) for the page being shown plus the number of pages
+    frame = filterFrame(frame, filter_query)
+    if sort_by:
+        frame = frame.sort_values([col['column_id'] for col in sort_by], ascending=[col['direction'] == 'asc' for col in sort_by], key=sortKey)
+    pagecount = max(1, -(-len(frame) // page_size))
+    records = frame.iloc[page_current * page_size:(page_current + 1) * page_size].to_dict('records')
+    tooltips = [
+        {
+            column:{'value': str(value), 'type':'markdown'}
+            for column, value in row.items()
+        } for row in records
+    ]
+    return records, tooltips, pagecount
+
+
+def pagedTable(tableid, frame):
+    # The full table stays in the frame store, the browser only ever gets the current page
+    key = frames.put(frame)
+    records, tooltips, pagecount = tablePage(frame, 0, PAGE_SIZE, [], '')
+    return [
+        dcc.Store(id=f"{tableid}key", data=key),
+        html.Button("Download CSV", id=f"{tableid}downloadbutton"),
+        dcc.Download(id=f"{tableid}download"),
+        dash_table.DataTable(
+            id=tableid,
+            data=records,
+            columns=[{"name":e, "id":e} for e in frame.columns],
+            page_action='custom',
+            page_current=0,
+            page_size=PAGE_SIZE,
+            page_count=pagecount,
+            sort_action='custom',
+            sort_mode='multi',
+            sort_by=[],
+            filter_action='custom',
+            filter_query='',
+            style_table={'overflowX':'auto'},
+            style_cell={'overflow':'hidden', 'textOverflow':'ellipsis', 'maxWidth':10, 'textAlign':'center'},
+            style_data={'color':'black', 'backgroundColor':'white'},
+            style_data_conditional=[{'if':{'row_index':'odd'}, 'backgroundColor': 'rgb(220,220,220)'}],
+            style_header={'backgroundColor': 'rgb(210,210,210)', 'color':'black', 'fontWeight':'bold', 'textAlign':'center'},
+            tooltip_data=tooltips,
+            tooltip_duration=None
+        )
+    ]
+
 ############################################
 #                                          #
 #                 Styles                   #
@@ -261,16 +381,14 @@ errorheader = html.Div(
 
 barcharts = html.Div(
     [
-        html.Div(
-            dbc.Spinner(html.Div(id='errorspinner'), color="primary")
-        ),
+        html.Div(id='qcprogress'),
         html.Div(
             #Count bar chart
             className='submissionStatusPlot',
             children=[
                 html.Hr(),
                 html.H2("Submission Status by Count", id='submissionstatusplottitle'),
-                dcc.Graph(id='submissionstatusplot')
+                dbc.Spinner(dcc.Graph(id='submissionstatusplot'), color="primary")
             ],
             style={'width':'49%', 'display':'inline-block'},
         ),
@@ -280,7 +398,7 @@ barcharts = html.Div(
             children=[
                 html.Hr(),
                 html.H2("Submission Status by Percentage", id="submissionPercentstatusplottitle"),
-                dcc.Graph(id="submissionPercentstatusplot")
+                dbc.Spinner(dcc.Graph(id="submissionPercentstatusplot"), color="primary")
             ],
             style={'width':'49%', 'display':'inline-block'},
         ),
@@ -370,8 +488,8 @@ batchcontent = html.Div(
 content = html.Div(id="page-content", style=CONTENT_STYLE)
 errorcontent = html.Div(
     [
-        html.Div(dbc.Spinner(html.Div(id="errorcontentspinner"), color="primary")),
-        html.Div(id="errorcontent", style=CONTENT_STYLE)
+        html.Div(id="errorprogress", style=CONTENT_STYLE),
+        dbc.Spinner(html.Div(id="errorcontent", style=CONTENT_STYLE), color="primary")
     ]
 )
 
@@ -379,11 +497,17 @@ errorcontent = html.Div(
 
 datacontent = html.Div(
     [
-        html.Div(dbc.Spinner(html.Div(id="datacontentspinner"), color="primary")),
-        html.Div(id="datacontent", style=CONTENT_STYLE)
+        html.Div(id="dataprogress", style=CONTENT_STYLE),
+        dbc.Spinner(html.Div(id="datacontent", style=CONTENT_STYLE), color="primary")
     ]
 )
 
+# Polls the page counts of long running fetches so the progress messages above stay current.  It only runs
+# while a selection is loading, see showProgress.
+progressinterval = dcc.Interval(id='progressinterval', interval=1000, disabled=True)
+# Ticks to keep polling after a selection before deciding nothing is loading, background jobs take a moment to start
+PROGRESS_GRACE = 5
+
 
 
 ####################################
@@ -393,7 +517,7 @@ datacontent = html.Div(
 ####################################
 
 
-app.layout = html.Div([sidebar,
+app.layout = html.Div([sidebar, progressinterval,
                        dcc.Tabs(id='tabs-container', value='tab-status',
                                 children=
                            [
@@ -449,14 +573,12 @@ app.layout = html.Div([sidebar,
 @app.callback(
     Output('studystore', 'data'),
     Input(component_id='tierselector', component_property='value'),
+    State(component_id='studystore', component_property='data'),
 )
-def populateStudyStore(tierselector):
-    studyjson = apiQuery(tierselector, dhq.org_query, None)
-    columns = ["_id","studyAbbreviation"]
-    study_df = pd.DataFrame(columns=columns)
-    for entry in studyjson['data']['getMyUser']['studies']:
-        study_df.loc[len(study_df)] = entry
-    return study_df.reset_index().to_json(orient='split')
+def populateStudyStore(tierselector, studystore):
+    if studystore is not None:
+        frames.drop(studystore)
+    return frames.put(loadStudies(tierselector))
 
 
 @app.callback(
@@ -464,47 +586,47 @@ def populateStudyStore(tierselector):
     Input(component_id='studystore', component_property='data'),
     State(component_id='studyselector', component_property='value'),
     State(component_id='tierselector', component_property='value'),
+    State(component_id='submissionstore', component_property='data'),
 )
-def populateSubmissionStore(studystore, studyselector, tierselector):
-    #Get a list of the submissions
-    subjson = apiQuery(tierselector, dhq.list_sub_query, {"status":["All"]})
-    sub_df = pd.DataFrame(subjson['data']['listSubmissions']['submissions'])
-    #Create the elapsedTime column
-    sub_df = elapsedTime(sub_df) 
-    return sub_df.reset_index().to_json(orient='split')
-
-
-###################### Spinner Callbacks ##################################
-
-
-
-@app.callback(
-    Output('datacontentspinner', 'children'),
-    Input(component_id='dataselector', component_property='value')
-)
-def loadDataSpinner(value):
-    time.sleep(5)
-    return value
-
+def populateSubmissionStore(studystore, studyselector, tierselector, submissionstore):
+    if submissionstore is not None:
+        frames.drop(submissionstore)
+    return frames.put(loadSubmissions(tierselector))
 
 
-@app.callback(
-    Output('errorspinner', 'children'),
-    Input(component_id='subselector', component_property='value')
-)
-def loadErrorSpinner(value):
-    time.sleep(5)
-    return value
+###################### Progress Callbacks ##################################
 
 
 
 @app.callback(
-    Output('errorcontentspinner', 'children'),
-    Input(component_id='errorselector', component_property='value')
+    Output('qcprogress', 'children'),
+    Output('errorprogress', 'children'),
+    Output('dataprogress', 'children'),
+    Output('progressinterval', 'disabled'),
+    Output('progressinterval', 'n_intervals'),
+    Input(component_id='progressinterval', component_property='n_intervals'),
+    Input(component_id='subselector', component_property='value'),
+    Input(component_id='errorselector', component_property='value'),
+    Input(component_id='dataselector', component_property='value'),
+    State(component_id='submissionstore', component_property='data'),
+    State(component_id='tierselector', component_property='value'),
 )
-def errorDetailSpinner(value):
-    time.sleep(5)
-    return value
+def showProgress(n_intervals, subselector, errorselector, dataselector, submissionstore, tierselector):
+    if dash.ctx.triggered_id != 'progressinterval':
+        # A selection changed and its callbacks are starting to load, poll until they are done
+        return None, None, None, False, 0
+    # Only the already stored submission list is used, a miss stops polling rather than reloading it
+    sub_df = frames.get(submissionstore)
+    if subselector is None or sub_df is None:
+        return None, None, None, True, dash.no_update
+    idlist = sub_df.query("name == @subselector")["_id"].tolist()
+    if len(idlist) == 0:
+        return None, None, None, True, dash.no_update
+    tier = dhc.normalizeTier(tierselector)
+    qcprogress = dhs.progressFor(('qc', tier, idlist[0]))
+    dataprogress = dhs.progressFor(('nodes', tier, idlist[0], dataselector))
+    idle = qcprogress is None and dataprogress is None and n_intervals >= PROGRESS_GRACE
+    return qcprogress, qcprogress, dataprogress, idle, dash.no_update
 
 
 
@@ -585,10 +707,11 @@ def batchTableTitle(subselector):
 # Study Selector
 @app.callback(
     Output("studyselector", "options"),
-    Input(component_id='studystore', component_property='data')
+    Input(component_id='studystore', component_property='data'),
+    State(component_id='tierselector', component_property='value')
 )
-def populateStudyDropdown(studystore):
-    study_df = pd.read_json(io.StringIO(studystore), orient='split')
+def populateStudyDropdown(studystore, tierselector):
+    study_df = storedFrame(studystore, loadStudies, tierselector)
     return study_df['studyAbbreviation'].unique()
 
 
@@ -596,13 +719,14 @@ def populateStudyDropdown(studystore):
 @app.callback(
     Output("subselector", "options"),
     Input(component_id='studyselector', component_property='value'),
-    State(component_id='submissionstore', component_property='data')
+    State(component_id='submissionstore', component_property='data'),
+    State(component_id='tierselector', component_property='value')
 )
-def populateSubmissionDropdown(studyselector, submissionstore):
+def populateSubmissionDropdown(studyselector, submissionstore, tierselector):
     if studyselector is None:
         raise PreventUpdate
     else:
-        sub_df = pd.read_json(io.StringIO(submissionstore),orient='split')
+        sub_df = storedFrame(submissionstore, loadSubmissions, tierselector)
         temp_df=sub_df[sub_df['studyAbbreviation'] == studyselector]
         return temp_df['name'].unique()
 
@@ -616,15 +740,14 @@ def populateSubmissionDropdown(studyselector, submissionstore):
     State(component_id='tierselector', component_property='value'),
 )
 def populateErrorSelector(subselector, submissionstore, tierselector):
-    sub_df = pd.read_json(io.StringIO(submissionstore), orient='split')
+    sub_df = storedFrame(submissionstore, loadSubmissions, tierselector)
     idlist = sub_df.query("name == @subselector")["_id"].tolist()
     if len(idlist)>=1:
-        queryvars = {"submissionID":idlist[0], "severity":"All", "first":-1, "offset":0, "sortDirection": "desc", "orderBy": "displayID"}
-        selector_res = apiQuery(tierselector, dhq.summaryQuery, queryvars)
-        if selector_res['data']['aggregatedSubmissionQCResults']['total'] == None:
+        snapshot = dhs.submissionSnapshot(tierselector, idlist[0], lazy=True)
+        if snapshot.summary is None:
             return []
         else:
-            val_df = pd.DataFrame(selector_res['data']['aggregatedSubmissionQCResults']['results'])
+            val_df = pd.DataFrame(snapshot.summary)
             return val_df['title'].unique()
     else:
         return []
@@ -639,13 +762,12 @@ def populateErrorSelector(subselector, submissionstore, tierselector):
     State(component_id='tierselector', component_property='value'),
 )
 def populateNodeSelector(subselector, submissionstore, tierselector):
-    sub_df = pd.read_json(io.StringIO(submissionstore),orient='split')
+    sub_df = storedFrame(submissionstore, loadSubmissions, tierselector)
     idlist = sub_df.query("name == @subselector")["_id"].tolist()
     if len(idlist) >= 1:
-        queryvars = {'id':idlist[0]}
-        selector_res = apiQuery(tierselector, dhq.submission_stats_query, queryvars)
+        snapshot = dhs.submissionSnapshot(tierselector, idlist[0], lazy=True)
         temp = []
-        for entry in selector_res['data']['submissionStats']['stats']:
+        for entry in snapshot.stats:
             temp.append(entry['nodeName'])
         return temp
     else:
@@ -660,9 +782,10 @@ def populateNodeSelector(subselector, submissionstore, tierselector):
     Output("page-content", "children"),
     Input(component_id='studyselector', component_property='value'),
     State(component_id='submissionstore', component_property='data'),
+    State(component_id='tierselector', component_property='value'),
 )
-def populateStudyInfoTable(studyselector, submissionstore):
-    sub_df = pd.read_json(io.StringIO(submissionstore),orient='split')
+def populateStudyInfoTable(studyselector, submissionstore, tierselector):
+    sub_df = storedFrame(submissionstore, loadSubmissions, tierselector)
     table_df = sub_df.loc[sub_df['studyAbbreviation'] == studyselector]
     data=table_df.to_dict('records')
     columns=[{"name":e, "id":e} for e in (table_df.columns)]
@@ -696,34 +819,19 @@ def populateStudyInfoTable(studyselector, submissionstore):
     State(component_id='tierselector', component_property='value'),
 )
 def populateDataTable(dataselector, submissionstore, subselector, tierselector):
-    sub_df = pd.read_json(io.StringIO(submissionstore),orient='split')
+    sub_df = storedFrame(submissionstore, loadSubmissions, tierselector)
     idlist = sub_df.query("name == @subselector")['_id'].tolist()
     if len(idlist) >= 1:
-        queryvars = {'_id':idlist[0], 'nodeType':dataselector, 'status':'All', 'first':-1, 'offset':0, 'orderBy':'studyID', 'sortDirection':'desc'}
-        data_res = apiQuery(tierselector, dhq.submission_nodes_query, queryvars)
-        if data_res['data']['getSubmissionNodes']['total'] == None:
+        queryvars = {'_id':idlist[0], 'nodeType':dataselector, 'status':'All', 'orderBy':'nodeID', 'sortDirection':'desc'}
+        key = ('nodes', dhc.normalizeTier(tierselector), idlist[0], dataselector)
+        try:
+            data_res = dhc.fetchAll(tierselector, dhq.submission_nodes_query, queryvars, 'getSubmissionNodes', progress=dhs.progressReporter(key, f"Loading {dataselector} nodes"))
+        finally:
+            dhs.clearProgress(key)
+        if data_res['total'] == None:
             return {}
         else:
-            data_df = pd.DataFrame(columns=data_res['data']['getSubmissionNodes']['properties'])
-            for entry in data_res['data']['getSubmissionNodes']['nodes']:
-                data_df.loc[len(data_df)] = json.loads(entry['props'])
-            return dash_table.DataTable(
-                data=data_df.to_dict('records'),
-                columns=[{"name": e, "id": e} for e in (data_df.columns)],
-                style_table={'overflowX':'auto'},
-                style_cell={'overflow':'hidden', 'textOverflow':'ellipsis', 'maxWidth':10, 'textAlign':'center'},
-                style_data={'color':'black', 'backgroundColor':'white'},
-                style_data_conditional=[{'if':{'row_index':'odd'}, 'backgroundColor': 'rgb(220,220,220)'}],
-                style_header={'backgroundColor': 'rgb(210,210,210)', 'color':'black', 'fontWeight':'bold', 'textAlign':'center'},
-                tooltip_data=[
-                    {
-                        column:{'value': str(value), 'type':'markdown'}
-                        for column, value in row.items()
-                    } for row in data_df.to_dict('records')
-                ],
-                tooltip_duration=None,
-                export_format="csv"
-            )
+            return pagedTable('datatable', dhn.nodeTable(data_res))
     else:
         return {}
 
@@ -735,49 +843,20 @@ def populateDataTable(dataselector, submissionstore, subselector, tierselector):
     State(component_id='submissionstore', component_property='data'),
     State(component_id='subselector', component_property='value'),
     State(component_id='tierselector', component_property='value'),
+    **backgroundOptions(Input('errorselector', 'value'), Input('subselector', 'value'))
 )
 def errorDetailTable(errorselector, submissionstore, subselector, tierselector):
-    sub_df = pd.read_json(io.StringIO(submissionstore),orient='split')
+    sub_df = storedFrame(submissionstore, loadSubmissions, tierselector)
     idlist = sub_df.query("name == @subselector")["_id"].tolist()
     if len(idlist)>=1:
-        subvars = {"submissionID":idlist[0], "severity":"All", "first":-1, "offset":0, "sortDirection": "desc", "orderBy": "displayID"}
-        sub_res = apiQuery(tierselector, dhq.summaryQuery, subvars)
-        if sub_res['data']['aggregatedSubmissionQCResults']['total'] == None:
+        snapshot = dhs.submissionSnapshot(tierselector, idlist[0], lazy=True)
+        if snapshot.summary is None:
             return {}
         else:   
-            #table_df = pd.DataFrame(sub_res['data']['aggregatedSubmissionQCResults']['results'])
-            errorvars = {"id": idlist[0], "severities":"All", "first": -1, "offset": 0, "orderBy":"displayID", "sortDirection":"desc"}
-            detail_res = apiQuery(tierselector, dhq.detailedQCQuery, errorvars)
-            columns = ['type', 'title', 'description']
-            error_df = pd.DataFrame(columns=columns)
-            for result in detail_res['data']['submissionQCResults']['results']:
-                for error in result['errors']:
-                    #the following filter is needed because if an entity has more then one error, all are returned by the system.  That's a feature, not a bug.
-                    if error['title'] == errorselector:
-                        error['type'] = 'Error'
-                        error_df.loc[len(error_df)] = error
-                #Do the same for warnings
-                for warning in result['warnings']:
-                    if warning['title'] == errorselector:
-                        warning['type'] = 'Warning'
-                        error_df.loc[len(error_df)] = warning
-            return dash_table.DataTable(
-                data=error_df.to_dict('records'),
-                columns=[{"name":e, "id":e} for e in (error_df.columns)],
-                style_table={'overflowX':'auto'},
-                style_cell={'overflow':'hidden', 'textOverflow':'ellipsis', 'maxWidth':10, 'textAlign':'center'},
-                style_data={'color':'black', 'backgroundColor':'white'},
-                style_data_conditional=[{'if':{'row_index':'odd'}, 'backgroundColor': 'rgb(220,220,220)'}],
-                style_header={'backgroundColor': 'rgb(210,210,210)', 'color':'black', 'fontWeight':'bold', 'textAlign':'center'},
-                tooltip_data=[
-                    {
-                        column:{'value': str(value), 'type':'markdown'}
-                        for column, value in row.items()
-                    } for row in error_df.to_dict('records')
-                ],
-                tooltip_duration=None,
-                export_format="csv"
-            )
+            #the title filter is needed because if an entity has more then one error, all are returned by the system.  That's a feature, not a bug.
+            selected = snapshot.qcIndex.select(title=errorselector)
+            error_df = pd.DataFrame({'type': selected['kind'].astype(str), 'title': selected['title'], 'description': selected['description']})
+            return pagedTable('errortable', error_df)
     else:
         return {}
 
@@ -789,64 +868,78 @@ def errorDetailTable(errorselector, submissionstore, subselector, tierselector):
     State(component_id='tierselector', component_property='value')
 )
 def populateBatchTable(subselector, submissionstore, tierselector):
-    submission_df = pd.read_json(io.StringIO(submissionstore), orient='split')
+    submission_df = storedFrame(submissionstore, loadSubmissions, tierselector)
     idlist = submission_df.query("name == @subselector")["_id"].tolist()
     if len(idlist)>=1:
-        queryvars = {"submissionID":idlist[0], "orderBy":"createdAt", "sortDirection":"DESC"}
-        batch_res = apiQuery(tierselector, dhq.list_batch_query, queryvars)
-        if batch_res['data']['listBatches']['total'] == None:
+        snapshot = dhs.submissionSnapshot(tierselector, idlist[0], lazy=True)
+        if snapshot.batches is None:
             return {}
         else:
-            batch_df = pd.DataFrame(columns=list(batch_res['data']['listBatches']['batches'][0].keys()))
-            for batch in batch_res['data']['listBatches']['batches']:
+            batch_df = pd.DataFrame(columns=list(snapshot.batches[0].keys()))
+            for batch in snapshot.batches:
                 batch_df.loc[len(batch_df)] = batch
             #Need to covert errors and files to string otherwise it borks the table
             batch_df['errors'] = batch_df['errors'].astype(str)
             batch_df['files'] = batch_df['files'].astype(str)
-            return dash_table.DataTable(
-                data=batch_df.to_dict('records'),
-                columns=[{"name":e, "id":e} for e in batch_df.columns],
-                style_table={'overflowX':'auto'},
-                style_cell={'overflow':'hidden', 'textOverflow':'ellipsis', 'maxWidth':10, 'textAlign':'center'},
-                style_data={'color':'black', 'backgroundColor':'white'},
-                style_data_conditional=[{'if':{'row_index':'odd'}, 'backgroundColor': 'rgb(220,220,220)'}],
-                style_header={'backgroundColor': 'rgb(210,210,210)', 'color':'black', 'fontWeight':'bold', 'textAlign':'center'},
-                tooltip_data=[
-                    {
-                        column:{'value': str(value), 'type':'markdown'}
-                        for column, value in row.items()
-                    } for row in batch_df.to_dict('records')
-                ],
-                tooltip_duration=None,
-                export_format="csv")
+            return pagedTable('batchtable', batch_df)
     else:
         return {}
 
 
+def registerPagedTable(tableid, filename):
+    # Paging, sorting and filtering are done here against the stored table, and the download button
+    # exports every row rather than just the page on screen
+    @app.callback(
+        Output(tableid, 'data'),
+        Output(tableid, 'tooltip_data'),
+        Output(tableid, 'page_count'),
+        Input(tableid, 'page_current'),
+        Input(tableid, 'page_size'),
+        Input(tableid, 'sort_by'),
+        Input(tableid, 'filter_query'),
+        State(f"{tableid}key", 'data'),
+    )
+    def updateTablePage(page_current, page_size, sort_by, filter_query, key):
+        frame = frames.get(key)
+        if frame is None:
+            raise PreventUpdate
+        return tablePage(frame, page_current, page_size, sort_by, filter_query)
+
+    @app.callback(
+        Output(f"{tableid}download", 'data'),
+        Input(f"{tableid}downloadbutton", 'n_clicks'),
+        State(f"{tableid}key", 'data'),
+    )
+    def downloadTable(n_clicks, key):
+        frame = frames.get(key)
+        if frame is None:
+            raise PreventUpdate
+        return dcc.send_data_frame(frame.to_csv, filename, index=False)
+
+
+registerPagedTable('datatable', 'submitted_data.csv')
+registerPagedTable('errortable', 'error_details.csv')
+registerPagedTable('batchtable', 'batches.csv')
+
+
 @app.callback(
     Output("validationerrorsummary", "children"),
     Input(component_id='subselector', component_property='value'),
     State(component_id='submissionstore', component_property='data'),
     State(component_id='tierselector', component_property='value'),
+    **backgroundOptions(Input('subselector', 'value'))
 )
 def validationErrorSummaryTable(subselector, submissionstore, tierselector):
-    sub_df = pd.read_json(io.StringIO(submissionstore),orient='split')
+    sub_df = storedFrame(submissionstore, loadSubmissions, tierselector)
     idlist = sub_df.query("name == @subselector")["_id"].tolist()
     if len(idlist) >= 1:
-        subvars = {"submissionID":idlist[0], "severity":"All", "first":-1, "offset":0, "sortDirection": "desc", "orderBy": "displayID"}
-        sub_res = apiQuery(tierselector, dhq.summaryQuery, subvars)
-        if sub_res['data']['aggregatedSubmissionQCResults']['total'] == None:
+        snapshot = dhs.submissionSnapshot(tierselector, idlist[0], lazy=True)
+        if snapshot.summary is None:
             return {}
         else:
-            columns = ['type', 'title', 'description']
-            error_df = pd.DataFrame(columns=columns)
-            errorvars = {"id": idlist[0], "severities":"Error", "first": -1, "offset": 0, "orderBy":"displayID", "sortDirection":"desc"}
-            detail_res = apiQuery(tierselector, dhq.detailedQCQuery, errorvars)
-            for result in detail_res['data']['submissionQCResults']['results']:
-                for error in result['errors']:
-                    message = bracketParse(error['description'])
-                    error_df.loc[len(error_df)] = {'type':'Error', 'title':error['title'], 'description':message}
-            summary_df = error_df.groupby(['title', 'description']).size().reset_index().rename(columns={0:'count'}).sort_values(by='count', ascending=False)
+            error_df = snapshot.qcIndex.select(kind='Error', severity='Error')[['title', 'description']]
+            error_df = error_df.assign(description=dqc.normalizeDescriptions(error_df['description']))
+            summary_df = error_df.groupby(['title', 'description'], observed=True).size().reset_index().rename(columns={0:'count'}).sort_values(by='count', ascending=False)
             return dash_table.DataTable(
                 data=summary_df.to_dict('records'),
                 columns=[{"name":e, "id":e} for e in summary_df.columns],
@@ -874,25 +967,19 @@ def validationErrorSummaryTable(subselector, submissionstore, tierselector):
     Input(component_id='subselector', component_property='value'),
     State(component_id='submissionstore', component_property='data'),
     State(component_id='tierselector', component_property='value'),
+    **backgroundOptions(Input('subselector', 'value'))
 )
 def validationWarningSummaryTable(subselector, submissionstore, tierselector):
-    sub_df = pd.read_json(io.StringIO(submissionstore),orient='split')
+    sub_df = storedFrame(submissionstore, loadSubmissions, tierselector)
     idlist = sub_df.query("name == @subselector")["_id"].tolist()
     if len(idlist) >= 1:
-        subvars = {"submissionID":idlist[0], "severity":"All", "first":-1, "offset":0, "sortDirection": "desc", "orderBy": "displayID"}
-        sub_res = apiQuery(tierselector, dhq.summaryQuery, subvars)
-        if sub_res['data']['aggregatedSubmissionQCResults']['total'] == None:
+        snapshot = dhs.submissionSnapshot(tierselector, idlist[0], lazy=True)
+        if snapshot.summary is None:
             return {}
         else:
-            columns = ['type', 'title', 'description']
-            error_df = pd.DataFrame(columns=columns)
-            errorvars = {"id": idlist[0], "severities":"Warning", "first": -1, "offset": 0, "orderBy":"displayID", "sortDirection":"desc"}
-            detail_res = apiQuery(tierselector, dhq.detailedQCQuery, errorvars)
-            for result in detail_res['data']['submissionQCResults']['results']:
-                for error in result['warnings']:
-                    message = bracketParse(error['description'])
-                    error_df.loc[len(error_df)] = {'type':'Error', 'title':error['title'], 'description':message}
-            temp_df = error_df.groupby(['title', 'description']).size().reset_index().rename(columns={0:'count'}).sort_values(by='count', ascending=False)
+            error_df = snapshot.qcIndex.select(kind='Warning', severity='Warning')[['title', 'description']]
+            error_df = error_df.assign(description=dqc.normalizeDescriptions(error_df['description']))
+            temp_df = error_df.groupby(['title', 'description'], observed=True).size().reset_index().rename(columns={0:'count'}).sort_values(by='count', ascending=False)
             summary_df = updateAggregation(temp_df)
             summary_df = summary_df.sort_values(by='count', ascending=False)
             return dash_table.DataTable(
@@ -926,15 +1013,14 @@ def validationWarningSummaryTable(subselector, submissionstore, tierselector):
     State(component_id='tierselector', component_property='value'),
 )
 def validationErrorPieChart(subselector, submissionstore, tierselector):
-    sub_df = pd.read_json(io.StringIO(submissionstore),orient='split')
+    sub_df = storedFrame(submissionstore, loadSubmissions, tierselector)
     idlist = sub_df.query("name == @subselector")["_id"].tolist()
     if len(idlist)>=1:
-        valvars = {"submissionID":idlist[0], "severity":"Error", "first":-1, "offset":0, "sortDirection": "desc", "orderBy": "displayID"}
-        val_res = apiQuery(tierselector, dhq.summaryQuery, valvars)
-        if val_res['data']['aggregatedSubmissionQCResults']['total'] == None:
+        results = dhs.submissionSnapshot(tierselector, idlist[0], lazy=True).summaryFor('Error')
+        if not results:
             return {}
         else:
-            val_df = pd.DataFrame(val_res['data']['aggregatedSubmissionQCResults']['results'])
+            val_df = pd.DataFrame(results)
             return px.pie(val_df, values='count', names='title', hole=.3)
     else:
         return {}
@@ -948,15 +1034,14 @@ def validationErrorPieChart(subselector, submissionstore, tierselector):
     State(component_id='tierselector', component_property='value'),
 )
 def validationWarningPieChart(subselector, submissionstore, tierselector):
-    sub_df = pd.read_json(io.StringIO(submissionstore),orient='split')
+    sub_df = storedFrame(submissionstore, loadSubmissions, tierselector)
     idlist = sub_df.query("name == @subselector")["_id"].tolist()
     if len(idlist)>=1:
-        valvars = {"submissionID":idlist[0], "severity":"Warning", "first":-1, "offset":0, "sortDirection": "desc", "orderBy": "displayID"}
-        val_res = apiQuery(tierselector, dhq.summaryQuery, valvars)
-        if val_res['data']['aggregatedSubmissionQCResults']['total'] == None:
+        results = dhs.submissionSnapshot(tierselector, idlist[0], lazy=True).summaryFor('Warning')
+        if not results:
             return {}
         else:
-            val_df = pd.DataFrame(val_res['data']['aggregatedSubmissionQCResults']['results'])
+            val_df = pd.DataFrame(results)
             return px.pie(val_df, values='count', names='title', hole=.3)
     else:
         return {}
@@ -970,14 +1055,13 @@ def validationWarningPieChart(subselector, submissionstore, tierselector):
     State(component_id='tierselector', component_property='value'),
 )
 def subStatusChart(subselector, submissionstore, tierselector):
-    sub_df = pd.read_json(io.StringIO(submissionstore),orient='split')
+    sub_df = storedFrame(submissionstore, loadSubmissions, tierselector)
     idlist = sub_df.query("name == @subselector")["_id"].tolist()
     if len(idlist) >= 1:
-        qvars = {'id': idlist[0]}
-        query_res = apiQuery(tierselector, dhq.submission_stats_query, qvars)
+        snapshot = dhs.submissionSnapshot(tierselector, idlist[0], lazy=True)
         columns = ['nodeName', 'total', 'new', 'error', 'warning', 'passed']
         substats_df = pd.DataFrame(columns=columns)
-        for entry in query_res['data']['submissionStats']['stats']:
+        for entry in snapshot.stats:
             substats_df.loc[len(substats_df)] = entry
         return px.bar(substats_df, x='nodeName', y=['new', 'error', 'warning', 'passed'])
     else:
@@ -992,14 +1076,13 @@ def subStatusChart(subselector, submissionstore, tierselector):
     State(component_id="tierselector", component_property="value")
 )
 def subStatusPercentageChart(subselector, submissionstore, tierselector):
-    sub_df = pd.read_json(io.StringIO(submissionstore),orient='split')
+    sub_df = storedFrame(submissionstore, loadSubmissions, tierselector)
     idlist = sub_df.query("name == @subselector")["_id"].tolist()
     if len(idlist) >=1:
-        qvars = {'id':idlist[0]}
-        query_res = apiQuery(tierselector, dhq.submission_stats_query, qvars)
+        snapshot = dhs.submissionSnapshot(tierselector, idlist[0], lazy=True)
         columns = ['nodeName', 'total', 'new', 'error', 'warning', 'passed']
         substats_df = pd.DataFrame(columns=columns)
-        for entry in query_res['data']['submissionStats']['stats']:
+        for entry in snapshot.stats:
             substats_df.loc[len(substats_df)] = entry
         #Add percentages to df
         calccolumns = columns = ['new', 'error', 'warning', 'passed']
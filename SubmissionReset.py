@@ -1,33 +1,9 @@
 # Gets a list of submissions associated witth the account and sends a query to reset the submission timer.
-import os
 import argparse
-import requests
 import pandas as pd
+import DH_Client as dhc
+import DH_Queries as dhq
 
-def apiQuery(tier, query, variables):
-    if tier == 'prod':
-        url = 'https://hub.datacommons.cancer.gov/api/graphql'
-        token = os.environ['PRODAPI']
-    elif tier == 'stage':
-        #Note that use of Stage is for example purposes only, actual submissions should use the production URL.  If you wish to run tests on Stage, please contact the helpdesk.
-        url = 'https://hub-stage.datacommons.cancer.gov/api/graphql'
-        token = os.environ['STAGEAPI']
-    else:
-        return('Please provide either "stage" or "prod" as tier values')
-    headers = {"Authorization": f"Bearer {token}"}
-    try:
-        if variables is None:
-            result = requests.post(url = url, headers = headers, json={"query": query})
-        else:
-            result = requests.post(url = url, headers = headers, json = {"query":query, "variables":variables})
-        if result.status_code == 200:
-            return result.json()
-        else:
-            print(f"Error: {result.status_code}")
-            return result.content
-    except requests.exceptions.HTTPError as e:
-        return(f"HTTP Error: {e}")
-    
 def main(args):
 
     list_sub_query = """
@@ -62,47 +38,41 @@ def main(args):
     }
 """
 
+    dhc.configure(pool_size=max(args.workers, dhc.POOL_SIZE), max_in_flight=args.workers, rate_limit=args.ratelimit, burst=args.workers)
     list_sub_vars = {"status": ['New', 'In Progress'], "first": -1}
     if args.verbose >= 1:
         print("Getting list of New and In Progress Submissions")
-    subres = apiQuery(args.tier.lower(), list_sub_query, list_sub_vars)
+    subres = dhc.apiQuery(args.tier.lower(), list_sub_query, list_sub_vars)
     sub_df = pd.DataFrame(subres['data']['listSubmissions']['submissions'])
     if args.verbose >= 2:
         print("Submissions to be updated")
         print(sub_df)
     sublist = sub_df['_id'].unique().tolist()
     
-    getSubmissionQuery = """
-        query GetSubmissions(
-            $id: ID!    
-        ){
-            getSubmission(_id:$id){
-                _id
-                name
-                dataCommons
-            }
-        }
-
-    """
     if args.verbose >= 1:
         print("Updating all New and In Progress submissions")
     if args.verbose >= 2:
             reslist = []
-    for submissionid in sublist:
-        checkvars = {"id": submissionid}
-        res = apiQuery(args.tier.lower(), getSubmissionQuery, checkvars)
-        if args.verbose >= 2:
-            reslist.append(res['data']['getSubmission'])
+    checklist = [{"_id": submissionid} for submissionid in sublist]
+    for check, res in zip(checklist, dhc.batchQuery(args.tier.lower(), dhq.get_submission_batch, checklist, args.batchsize, args.workers)):
+        if isinstance(res, dhc.BatchError):
+            print(f"Submission {check['_id']} returned errors: {res.messages}")
+        elif args.verbose >= 2:
+            reslist.append(res)
     if args.verbose >= 2:
         print("Updated submissions")
         res_df = pd.DataFrame(reslist)
         print(res_df)
+        print(f"API request metrics: {dhc.limiterMetrics(args.tier.lower())}")
 
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", "--tier", required=True,  help="System tier.  'stage" or 'prod')
+    parser.add_argument('-b', '--batchsize', type=int, default=100, help="Number of submissions checked in each request")
+    parser.add_argument('-w', '--workers', type=int, default=1, help="Number of requests run concurrently")
+    parser.add_argument('-l', '--ratelimit', type=float, default=0, help="Maximum requests per second, 0 for no limit")
     parser.add_argument('-v', '--verbose', action='count', default=0, help=("Verbosity: -v main section -vv subroutine messages -vvv data returned shown"))
 
     args = parser.parse_args()
@@ -1,33 +1,13 @@
 import argparse
-import requests
 import os
-import json
+import sqlite3
 import pandas as pd
 import numpy as np
 import yaml
-
-error_query = """
-query retrieveReleasedDataByID(
-    $submissionID: String!,
-    $nodeType: String!
-    $nodeID: String!
-){
-retrieveReleasedDataByID(
-    submissionID: $submissionID,
-    nodeType: $nodeType
-    nodeID: $nodeID
-){
-    submissionID
-    status
-    dataCommons
-    dataCommonsDisplayName
-    studyID
-    nodeType
-    nodeID
-    props
-}
-}
-"""
+import DH_Client as dhc
+import DH_Queries as dhq
+import DH_Nodes as dhn
+import SubmissionMirror as mirror
 
 submission_nodes_query = """
 query getSubmissionNodes(
@@ -81,84 +61,260 @@ def readYAML(yamlfile):
 
 
 
-def apiQuery(tier, query, variables):
-    if tier == 'prod':
-        url = 'https://hub.datacommons.cancer.gov/api/graphql'
-        token = os.environ['PRODAPI']
-    elif tier == 'stage':
-        #Note that use of Stage is for example purposes only, actual submissions should use the production URL.  If you wish to run tests on Stage, please contact the helpdesk.
-        url = 'https://hub-stage.datacommons.cancer.gov/api/graphql'
-        token = os.environ['STAGEAPI']
-    else:
-        return('Please provide either "stage" or "prod" as tier values')
-    headers = {"Authorization": f"Bearer {token}"}
-    try:
-        if variables is None:
-            result = requests.post(url = url, headers = headers, json={"query": query})
-        else:
-            result = requests.post(url = url, headers = headers, json = {"query":query, "variables":variables})
-        if result.status_code == 200:
-            return result.json()
+def releasedTable(releasedlist):
+    # Builds one table out of every retrieveReleasedDataByID result in releasedlist, keyed by (nodeID, submission_id).
+    # Failed (None) and errored (BatchError) lookups are skipped.
+    props = []
+    keys = []
+    for released in releasedlist:
+        if released is None or isinstance(released, dhc.BatchError):
+            continue
+        for entry in released:
+            props.append(entry['props'])
+            keys.append((entry['nodeID'], entry['submissionID']))
+    return pd.DataFrame.from_records(dhn.decodeProps(props), index=pd.MultiIndex.from_tuples(keys, names=['nodeID', 'submission_id']))
+
+
+def diffReleased(table, subid):
+    # Compares the new (subid) version of every node in table against its released version in one pass.
+    # Returns the changed rows as alternating Existing/New lines and a field level list of old/new values.
+    if len(table) == 0:
+        return None, None
+    submissions = table.index.get_level_values('submission_id')
+    new_df = table[submissions == subid].droplevel('submission_id')
+    old_df = table[submissions != subid]
+    # Only the first released version of a node is compared, same as the old per-node diff
+    old_df = old_df[~old_df.index.get_level_values('nodeID').duplicated(keep='first')]
+    old_subs = pd.Series(old_df.index.get_level_values('submission_id'), index=old_df.index.get_level_values('nodeID'))
+    old_df = old_df.droplevel('submission_id')
+    common = old_df.index[old_df.index.isin(new_df.index)]
+    new_df = new_df.loc[common]
+    old_df = old_df.loc[common]
+    changed = new_df.ne(old_df) & ~(new_df.isna() & old_df.isna())
+    changedrows = changed.any(axis=1).to_numpy()
+    if not changedrows.any():
+        return None, None
+
+    old_rows = old_df[changedrows]
+    new_rows = new_df[changedrows]
+    count = len(old_rows)
+    report_df = pd.concat([old_rows, new_rows])
+    report_df.index = list(old_subs.loc[old_rows.index]) + [subid] * count
+    # Interleave so each Existing line is directly followed by its New line
+    report_df = report_df.iloc[np.column_stack([np.arange(count), np.arange(count) + count]).ravel()]
+
+    rowpos, colpos = np.nonzero(changed.to_numpy())
+    changes_df = pd.DataFrame({
+        'field': changed.columns[colpos],
+        'old_value': old_df.to_numpy()[rowpos, colpos],
+        'new_value': new_df.to_numpy()[rowpos, colpos]
+    }, index=pd.Index(common[rowpos], name='nodeID'))
+    return report_df, changes_df
+
+
+class DiffWriter:
+    # Appends each node's diff rows to the output file as they come in.  The header is written with the
+    # first chunk and later chunks are lined up to those columns, so the file is only ever written once.
+    def __init__(self, filename, subid, properties=None, addstate=True, append=False):
+        self.filename = filename
+        self.subid = subid
+        self.properties = properties
+        self.addstate = addstate
+        self.append = append
+        self.columns = None
+        self.handle = None
+        self.rows = 0
+
+    def write(self, report_df):
+        if self.addstate:
+            report_df.index.name = 'submission_id'
+            report_df.insert(0, 'submission_state', np.where(report_df.index == self.subid, 'New', 'Existing'))
+        if self.handle is None and self.append and os.path.exists(self.filename) and os.path.getsize(self.filename) > 0:
+            # Resuming a run, keep adding to the existing file under its existing header
+            self.columns = list(pd.read_csv(self.filename, sep="\t", index_col=0, nrows=0).columns)
+            self.handle = open(self.filename, 'a', newline='')
+            report_df.reindex(columns=self.columns).to_csv(self.handle, sep="\t", header=False)
+        elif self.handle is None:
+            self.columns = []
+            if self.addstate:
+                self.columns.append('submission_state')
+            if self.properties is not None:
+                self.columns.extend(self.properties)
+            for column in report_df.columns:
+                if column not in self.columns:
+                    self.columns.append(column)
+            self.handle = open(self.filename, 'w', newline='')
+            report_df.reindex(columns=self.columns).to_csv(self.handle, sep="\t")
         else:
-            print(f"Error: {result.status_code}")
-            return result.content
-    except requests.exceptions.HTTPError as e:
-        return(f"HTTP Error: {e}")
-
-
-def diffDataFrame(subid, nodetype, nodeID, tier, query):
-    difflist = []
-    variables = {'submissionID': subid , 'nodeType': nodetype, 'nodeID': nodeID}
-    diffres = apiQuery(tier, query, variables)
-    dfcollection = {}
-    if 'errors' in diffres:
-        return None
-    else:
-        for entry in diffres['data']['retrieveReleasedDataByID']:
-            propstuff = json.loads(entry['props'])
-            temp_df = pd.DataFrame(propstuff, index=[entry['submissionID']])
-            dfcollection[entry['submissionID']] = temp_df
-            keylist = list(dfcollection.keys())
-            if len(keylist) >= 2:
-                df1 = dfcollection[keylist[0]]
-                df2 = dfcollection[keylist[1]]
-                diff_df = pd.concat([df1, df2]).drop_duplicates(keep=False)
-                difflist.append(diff_df)
-        report_df = pd.concat(difflist)
-        return report_df
-
-        
+            report_df.reindex(columns=self.columns).to_csv(self.handle, sep="\t", header=False)
+        self.handle.flush()
+        self.rows = self.rows + len(report_df)
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+
+class Checkpoint:
+    # SQLite journal of the (subid, node, nodeID) lookups that have been written out, so a rerun after a
+    # crash or network failure only fetches what is missing.  A filename of None keeps the journal in memory.
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = ':memory:'
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS done (subid TEXT, node TEXT, nodeid TEXT, PRIMARY KEY (subid, node, nodeid))")
+        self.conn.commit()
+
+    def completed(self, subid, node):
+        rows = self.conn.execute("SELECT nodeid FROM done WHERE subid = ? AND node = ?", (subid, node))
+        return set(row[0] for row in rows)
+
+    def markDone(self, subid, node, nodeids):
+        self.conn.executemany("INSERT OR IGNORE INTO done VALUES (?, ?, ?)", [(subid, node, nodeid) for nodeid in nodeids])
+        self.conn.commit()
+
+    def clear(self):
+        self.conn.execute("DELETE FROM done")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def writeDiffs(chunk, subid, node, writer, changewriter, checkpoint, verbose=0):
+    # chunk is a list of (lookup variables, released result) pairs.  Returns the number of failed and errored lookups.
+    report_df, changes_df = diffReleased(releasedTable([released for variables, released in chunk]), subid)
+    if report_df is not None:
+        writer.write(report_df)
+        changewriter.write(changes_df)
+    # A lookup the API answered with errors (such as a node with no released record) has nothing to diff,
+    # same as before.  It is journaled like a good one since asking again gives the same answer.
+    errored = [(variables, released) for variables, released in chunk if isinstance(released, dhc.BatchError)]
+    if verbose >= 2:
+        for variables, released in errored:
+            print(f"{variables['nodeID']} lookup returned errors: {released.messages}")
+    # Failed requests are left out of the journal so the next run picks them up again
+    checkpoint.markDone(subid, node, [variables['nodeID'] for variables, released in chunk if released is not None])
+    return len([released for variables, released in chunk if released is None]), len(errored)
 
 
 def main(args):
     if args.verbose >= 1:
         print(f"Reading config file {args.configfile}")
     configs = readYAML(args.configfile)
+    # Command line setting wins over the config file, default is the original one-at-a-time behavior
+    if args.workers is not None:
+        workers = args.workers
+    else:
+        workers = configs.get('workers', 1)
+    # Never let more than maxinflight lookups hit the API at once, even with a large worker pool
+    maxinflight = configs.get('maxinflight', workers)
+    # Number of released data lookups packed into each request
+    if args.batchsize is not None:
+        batchsize = args.batchsize
+    else:
+        batchsize = configs.get('batchsize', 100)
+    # Number of nodes read from getSubmissionNodes in each page
+    pagesize = configs.get('pagesize', dhc.PAGE_SIZE)
+    # Optional requests per second budget shared by all the workers
+    ratelimit = configs.get('ratelimit', 0)
+    dhc.configure(pool_size=max(workers, dhc.POOL_SIZE), max_in_flight=maxinflight, rate_limit=ratelimit, burst=maxinflight)
+    if args.verbose >= 1:
+        print(f"Using {workers} workers with at most {maxinflight} requests in flight")
+        if ratelimit > 0:
+            print(f"Limiting requests to {ratelimit} per second")
+    # Optional persistent response cache, lets a rerun replay responses it already has if the API is struggling
+    if configs.get('cachefile') is not None:
+        dhc.enableCache(diskfile=configs['cachefile'])
+    if args.checkpoint is not None:
+        checkpointfile = args.checkpoint
+    else:
+        checkpointfile = configs.get('checkpoint')
+    checkpoint = Checkpoint(checkpointfile)
+    # Optional local mirror from SubmissionMirror.py, node lists are read from it instead of the API
+    mirrorconn = None
+    if configs.get('mirror') is not None:
+        mirrorconn = mirror.openMirror(configs['mirror'])
+        if args.verbose >= 1:
+            print(f"Reading nodes from mirror {configs['mirror']}")
+    if args.restart:
+        checkpoint.clear()
+    elif checkpointfile is not None and args.verbose >= 1:
+        print(f"Resuming from checkpoint {checkpointfile}")
+    # Set when anything is left for a rerun to pick up
+    incomplete = False
 
     for subid in configs['subid']:
         if args.verbose >= 1:
             print(f"Processing submission ID {subid}")
         for node in configs['nodelist']:
-            nodedlist = []
-            node_vars = {'_id':subid, 'nodeType':node, 'status':configs['severity'], 'first':-1, 'offset':0, 'orderBy':'studyID', 'sortDirection':'desc'}
-            nodedata_res = apiQuery(configs['tier'], submission_nodes_query, node_vars)
-            #Set up the dataframe needed to query for errors
-            for result in nodedata_res['data']['getSubmissionNodes']['nodes']:
-                nodetype = result['nodeType']
-                nodeid = result['nodeID']
-                report_df = diffDataFrame(subid, nodetype, nodeid, 'stage', error_query)
-                if report_df is not None:
-                    nodedlist.append(report_df)
-                    report_df = pd.concat(nodedlist)
-                    report_df.index.name = 'submission_id'
-                    report_df['submission_state'] = np.where(report_df.index == subid, 'New', 'Existing')
-                    col = report_df.pop('submission_state')
-                    report_df.insert(0, 'submission_state', col)
-                    report_df.to_csv(f"{configs['outputdirectory']}{subid}_{node}_warning_diffs.csv", sep="\t")
+            node_vars = {'_id':subid, 'nodeType':node, 'status':configs['severity'], 'orderBy':'nodeID', 'sortDirection':'desc'}
+            done = checkpoint.completed(subid, node)
+            writer = None
+            changewriter = None
+            checked = 0
+            failed = 0
+            errored = 0
+            try:
+                # Nodes are read pagesize at a time so the whole node list never has to be held in memory
+                if mirrorconn is not None:
+                    pages = mirror.readNodePages(mirrorconn, subid, node, pagesize, configs['severity'])
+                else:
+                    pages = dhc.paginate(configs['tier'], submission_nodes_query, node_vars, 'getSubmissionNodes', pagesize, prefetch=True)
+                for page in pages:
+                    if writer is None:
+                        writer = DiffWriter(f"{configs['outputdirectory']}{subid}_{node}_warning_diffs.csv", subid, page['properties'], append=len(done) > 0)
+                        changewriter = DiffWriter(f"{configs['outputdirectory']}{subid}_{node}_field_changes.csv", subid, addstate=False, append=len(done) > 0)
+                    #Set up the dataframe needed to query for errors
+                    varlist = []
+                    for result in page['nodes']:
+                        if result['nodeID'] not in done:
+                            varlist.append({'submissionID': subid, 'nodeType': result['nodeType'], 'nodeID': result['nodeID']})
+                    checked = checked + len(varlist)
+                    # Diff a whole batch of nodes at a time instead of one node at a time
+                    chunk = []
+                    for variables, released in zip(varlist, dhc.batchQuery(configs['tier'], dhq.released_data_batch, varlist, batchsize, workers)):
+                        chunk.append((variables, released))
+                        if len(chunk) >= batchsize:
+                            counts = writeDiffs(chunk, subid, node, writer, changewriter, checkpoint, args.verbose)
+                            failed = failed + counts[0]
+                            errored = errored + counts[1]
+                            chunk = []
+                    counts = writeDiffs(chunk, subid, node, writer, changewriter, checkpoint, args.verbose)
+                    failed = failed + counts[0]
+                    errored = errored + counts[1]
+            except dhc.PageError as e:
+                incomplete = True
+                print(f"Unable to get all {node} nodes for {subid}, rerun to retry: {e}")
+            if writer is not None:
+                writer.close()
+                changewriter.close()
+                if args.verbose >= 1:
+                    print(f"{node}: {len(done)} nodes already done, {checked} checked, wrote {writer.rows} rows")
+            if failed > 0:
+                incomplete = True
+                print(f"{failed} {node} lookups failed for {subid}, rerun to retry them")
+            if errored > 0 and args.verbose >= 1:
+                print(f"{errored} {node} lookups for {subid} returned errors and were skipped, -vv lists them")
+    if not incomplete and checkpointfile is not None:
+        # Everything was written, so the next run starts over instead of skipping every node
+        checkpoint.clear()
+        if args.verbose >= 1:
+            print(f"Run complete, cleared checkpoint {checkpointfile}")
+    checkpoint.close()
+    if mirrorconn is not None:
+        mirrorconn.close()
+    if args.verbose >= 2:
+        print(f"API request metrics: {dhc.limiterMetrics(configs['tier'])}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--configfile", required=True,  help="Configuration file containing all the input info")
+    parser.add_argument('-b', '--batchsize', type=int, default=None, help="Number of released data lookups sent in each request.  Overrides the batchsize setting in the config file")
+    parser.add_argument('-w', '--workers', type=int, default=None, help="Number of released data lookup requests run concurrently.  Overrides the workers setting in the config file")
+    parser.add_argument('-k', '--checkpoint', default=None, help="SQLite checkpoint file used to resume an interrupted run.  Overrides the checkpoint setting in the config file")
+    parser.add_argument('-r', '--restart', action='store_true', help="Ignore any existing checkpoint and start over")
     parser.add_argument('-v', '--verbose', action='count', default=0, help=("Verbosity: -v main section -vv subroutine messages -vvv data returned shown"))
 
     args = parser.parse_args()